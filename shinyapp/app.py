@@ -3,20 +3,36 @@
 from __future__ import annotations
 
 import asyncio
-import base64
-import json
 import os
-import re
-from copy import deepcopy
-from pathlib import Path
-from typing import Literal, TypedDict, cast
-from urllib.parse import parse_qs
-
-from anthropic import APIStatusError, AsyncAnthropic, RateLimitError
-from anthropic.types import CacheControlEphemeralParam, MessageParam
-from app_utils import load_dotenv
+from typing import Literal, cast
+
+from anthropic import AsyncAnthropic
+from anthropic.types import MessageParam
+from app_utils import load_dotenv, read_file
+from chat_responses import ChatResponder, active_stream_count
+from file_assets import SessionAssetStore
+from file_sync import FileSetSync
 from htmltools import Tag
-from local_types import MessageParam2
+from llm_stream import TurnContext
+from local_types import FileContent
+from message_prep import prepare_messages
+from payloads import (
+    PayloadTooLarge,
+    decode_restore_hash_async,
+    editor_files_json_async,
+)
+from profiling import install_profiler_signal_handler, timed
+from prompt_cache import prompt_cache_warmer
+from prompts import build_app_prompt
+from routing import has_editor_code, route_request
+from session_memory import memory_tracker, process_rss_bytes
+from shared_state import LoadReporter, shared_state, worker_id
+from shinyapp_tags import (
+    ShinyappStreamEvent,
+    ShinyappStreamTracker,
+    shinyapp_tag_contents_to_filecontents,
+    transform_response_chunk,
+)
 from shiny import App, Inputs, Outputs, Session, reactive, render, ui
 from shiny.ui._card import CardItem
 
@@ -32,26 +48,16 @@ api_key = os.environ.get("ANTHROPIC_API_KEY")
 if api_key is None:
     raise ValueError("Please set the ANTHROPIC_API_KEY environment variable.")
 
-google_analytics_id = os.environ.get("GOOGLE_ANALYTICS_ID", None)
-
-# email_sig_key = os.environ.get("EMAIL_SIGNATURE_KEY", None)
-
-app_dir = Path(__file__).parent
-
-
-# Read the contents of a file, where the base path defaults to current dir of this file.
-def read_file(filename: Path | str, base_dir: Path = app_dir) -> str:
-    with open(base_dir / filename, "r") as f:
-        res = f.read()
-        return res
+# Maximum number of requests per minute that use the server's API key, across all
+# worker processes. 0 means no limit.
+rate_limit_per_minute = int(os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE", "0"))
 
+google_analytics_id = os.environ.get("GOOGLE_ANALYTICS_ID", None)
 
-app_prompt_template = read_file("app_prompt.md")
+# Capture a profile when the process gets SIGUSR1, if PROFILE_DIR is set.
+install_profiler_signal_handler()
 
-app_prompt_language_specific = {
-    "r": read_file("app_prompt_r.md"),
-    "python": read_file("app_prompt_python.md"),
-}
+# email_sig_key = os.environ.get("EMAIL_SIGNATURE_KEY", None)
 
 
 greeting = """
@@ -84,12 +90,6 @@ Let's get started! 🚀
 """
 
 
-class FileContent(TypedDict):
-    name: str
-    content: str
-    type: Literal["text", "binary"]
-
-
 switch_tag = ui.input_switch("language_switch", "Python", False)
 switch_tag.add_style("width: unset; display: inline-block; padding: 0 20px;")
 switch_tag.children[0].add_style("display: inline-block;")  # pyright: ignore
@@ -222,6 +222,18 @@ for child in app_ui.children:
         break
 
 
+load_reporter = LoadReporter(
+    shared_state,
+    worker_id,
+    lambda: {
+        "sessions": memory_tracker.session_count,
+        "active_streams": active_stream_count(),
+        "session_bytes": memory_tracker.total_bytes(),
+        "rss_bytes": process_rss_bytes(),
+    },
+)
+
+
 def server(input: Inputs, output: Outputs, session: Session):
     # with reactive.isolate():
     #     hostname = input[".clientdata_url_hostname"]()
@@ -234,6 +246,26 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     restoring = True
 
+    # Keep track of the approximate memory held by this session. If the session
+    # is evicted, closing it causes the client to save its state to the URL hash
+    # and show the reconnect modal, which restores the session.
+    memory_tracker.register(session.id, session.close)
+    session.on_ended(lambda: memory_tracker.unregister(session.id))
+    # The session's API client is created when it's first needed, but it's
+    # counted from the start, so that llm() doesn't have a side effect.
+    memory_tracker.update(session.id, has_client=True)
+
+    if prompt_cache_warmer is not None:
+        prompt_cache_warmer.start(api_key)
+    load_reporter.start()
+
+    # This must be a coroutine function: with a lambda, the coroutine returned by
+    # responder.cancel_stream() would never be awaited.
+    async def cancel_stream_on_session_end():
+        await responder.cancel_stream("session ended")
+
+    session.on_ended(cancel_stream_on_session_end)
+
     shinylive_panel_visible = reactive.value(False)
     shinylive_panel_visible_smooth_transition = reactive.value(True)
 
@@ -246,59 +278,77 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @reactive.calc
     def app_prompt() -> str:
-        verbosity_instructions = {
-            "Code only": "If you are providing a Shiny app, please provide only the code."
-            " Do not add any other text, explanations, or instructions unless"
-            " absolutely necessary. Do not tell the user how to install Shiny or run"
-            " the app, because they already know that.",
-            "Concise": "Be concise when explaining the code."
-            " Do not tell the user how to install Shiny or run the app, because they"
-            " already know that.",
-            "Verbose": "",  # The default behavior of Claude is to be verbose
-        }
-
-        prompt = app_prompt_template.format(
-            language=language(),
-            language_specific_prompt=app_prompt_language_specific[language()],
-            verbosity=verbosity_instructions[input.verbosity()],
-        )
-        return prompt
+        return build_app_prompt(language(), input.verbosity())
+
+    def start_turn() -> TurnContext:
+        with reactive.isolate():
+            return TurnContext(
+                client=llm(),
+                system_prompt=app_prompt(),
+                language=language(),
+                verbosity=input.verbosity(),
+                uses_server_api_key=not input.use_api_key(),
+            )
 
-    restored_messages: list[dict[str, str]] = []
+    chat = ui.Chat("chat")
 
-    def parse_hash(input: Inputs) -> dict[str, list[str]]:
+    # Restore the conversation that the client saved in the URL hash, or add a
+    # starting message if there isn't one. The saved conversation can be large, so
+    # it's decoded without blocking the event loop, and refused if it's too large.
+    # Everything that this reads is isolated, so it only runs once.
+    @reactive.effect
+    async def _restore_chat():
         with reactive.isolate():
-            if ".clientdata_url_hash" not in input:
-                return {}
-            hash = input[".clientdata_url_hash_initial"]()
-            if hash == "":
-                return {}
-            # Remove leading # from qs, if present
-            if hash.startswith("#"):
-                hash = hash[1:]
-            return parse_qs(hash, strict_parsing=True)
-
-    parsed_qs = parse_hash(input)
-    if "chat_history" in parsed_qs:
-        restored_messages = json.loads(
-            base64.b64decode(parsed_qs["chat_history"][0]).decode("utf-8")
-        )
+            hash = (
+                input[".clientdata_url_hash_initial"]()
+                if ".clientdata_url_hash" in input
+                else ""
+            )
 
-    # Add a starting message, but only if no messages were restored.
-    if len(restored_messages) == 0:
-        restored_messages.insert(0, {"role": "assistant", "content": greeting})
+        restored_messages: list[dict[str, str]] = []
+        try:
+            restored = await decode_restore_hash_async(hash)
+            restored_messages = restored["messages"]
+            if restored["has_files"]:
+                shinylive_panel_visible_smooth_transition.set(False)
+                shinylive_panel_visible.set(True)
+        except PayloadTooLarge as e:
+            ui.notification_show(
+                f"{e} Starting a new conversation instead.",
+                type="warning",
+                duration=None,
+            )
+        except Exception as e:
+            print(f"Error restoring conversation: {e}")
+            ui.notification_show(
+                "The saved conversation could not be restored. Starting a new "
+                "conversation instead.",
+                type="warning",
+                duration=None,
+            )
 
-    if "files" in parsed_qs and parsed_qs["files"]:
-        shinylive_panel_visible_smooth_transition.set(False)
-        shinylive_panel_visible.set(True)
+        # Add a starting message, but only if no messages were restored.
+        if len(restored_messages) == 0:
+            restored_messages.insert(0, {"role": "assistant", "content": greeting})
 
-    chat = ui.Chat(
-        "chat",
-        messages=restored_messages,
-    )
+        for message in restored_messages:
+            await chat.append_message(message)
+
+    # Whether a call to sync_latest_messages_locked() is scheduled but hasn't run
+    # yet. When restoring, every restored message finishes at once, and a single
+    # sync sends all of them.
+    sync_scheduled = False
+
+    def schedule_sync_latest_messages():
+        nonlocal sync_scheduled
+        if not sync_scheduled:
+            sync_scheduled = True
+            asyncio.create_task(sync_latest_messages_locked())
 
     async def sync_latest_messages_locked():
+        nonlocal sync_scheduled
         async with reactive.lock():
+            sync_scheduled = False
             await sync_latest_messages()
 
     @render.ui
@@ -328,104 +378,49 @@ def server(input: Inputs, output: Outputs, session: Session):
     # @chat.on_user_submit. This will require some changes to the chat component.
     @reactive.effect
     @reactive.event(input.message_trigger)
+    @timed()
     async def _send_user_message():
         nonlocal restoring
         restoring = False
+        responder.start_user_turn()
+        turn = start_turn()
+
+        try:
+            editor_json = await editor_files_json_async(editor_files())
+        except PayloadTooLarge as e:
+            # Respond in the chat, so that the chat input is enabled again.
+            await chat.append_message(
+                {
+                    "role": "assistant",
+                    "content": f"**Error:** {e} Remove or shorten some of the files in the editor, and try again.",
+                }
+            )
+            return
+
+        await responder.cancel_stream("new user message")
 
         messages: tuple[MessageParam, ...] = (
             chat.messages(  # pyright: ignore[reportUnknownMemberType]
-                token_limits=(32000, 6000), format="anthropic"
+                format="anthropic"
             )
         )
 
         # messages2 is a MessageParam2, which helps with type checking here. We
         # will assign it back to messages later.
-        messages2 = normalize_messages(messages)
-        messages2 = add_cache_breakpoints_to_messages(messages2)
+        messages2, prompt = prepare_messages(messages, editor_json)
 
-        # We add this last message part after adding the cache breakpoint,
-        # because this message part will not be used in future message turns.
-        messages2[-1]["content"].append(
-            {
-                "type": "text",
-                "text": f"""
-<CONTEXT>
-The following is the current app code in JSON format. The text that came before this app
-code might ask you to modify the code. If , please modify the code. If the text
-did not ask you to modify the code, then ignore the code.
-
-```
-{input.editor_code()}
-```
-</CONTEXT>
-""",
-            }
+        # Pick the model and token budget based on what kind of request this is.
+        route = route_request(
+            prompt=prompt,
+            has_editor_code=has_editor_code(editor_files()),
+            verbosity=turn.verbosity,
         )
 
         messages = cast(tuple[MessageParam, ...], messages2)
 
         await sync_latest_messages()
 
-        # Create a response message stream
-        try:
-            response_stream = await llm().messages.create(
-                model="claude-sonnet-4-20250514",
-                system=[
-                    {
-                        "type": "text",
-                        "text": app_prompt(),
-                        "cache_control": {"type": "ephemeral"},
-                    }
-                ],
-                messages=messages,
-                stream=True,
-                max_tokens=3000,
-            )
-        except Exception as e:
-            await check_for_overload(e)
-            await chat._raise_exception(e)
-            return
-
-        files_in_shinyapp_tags.set(None)
-
-        async def logging_stream_wrapper():
-            try:
-                async for chunk in response_stream:
-                    if (
-                        chunk.type == "content_block_delta"
-                        and chunk.delta.type == "text_delta"
-                    ):
-                        ...
-                        # print(chunk.delta.text, end="")
-                    else:
-                        ...
-                        # Uncomment to view other chunks, which include response metadata
-                        # print(json.dumps(chunk.model_dump(), indent=2))
-                    yield chunk
-                # print("")
-            except Exception as e:
-                await check_for_overload(e)
-                raise
-
-        # Append the response stream into the chat
-        await chat.append_message_stream(logging_stream_wrapper())
-
-    async def check_for_overload(e: Exception):
-        if isinstance(e, RateLimitError):
-            await chat.append_message(
-                {
-                    "role": "assistant",
-                    "content": "**Error:** Shiny Assistant has exceeded its Anthropic rate limit. Please try again later, or provide your own Anthropic API key using the gear icon above.",
-                }
-            )
-        elif isinstance(e, APIStatusError):
-            if e.status_code == 529:
-                await chat.append_message(
-                    {
-                        "role": "assistant",
-                        "content": "**Error:** Shiny Assistant's access to Anthropic is currently overloaded. Please try again later, or provide your own Anthropic API key using the gear icon above.",
-                    }
-                )
+        await responder.stream_response(turn, messages, route)
 
     # ==================================================================================
     # Code for finding content in the <SHINYAPP> tags and sending to the client
@@ -434,66 +429,135 @@ did not ask you to modify the code, then ignore the code.
     files_in_shinyapp_tags: reactive.Value[list[FileContent] | None] = reactive.Value(
         None
     )
+    # Tracks the <SHINYAPP> tags in the response that is currently streaming.
+    shinyapp_tracker = ShinyappStreamTracker()
+
+    # Called with the reactive lock held, when the response that is streaming opens
+    # or closes a <SHINYAPP> tag.
+    def on_shinyapp_tags(events: list[ShinyappStreamEvent], content: str) -> None:
+        # If we see the <SHINYAPP> tag, make sure the shinylive panel is visible.
+        if "opened" in events:
+            shinylive_panel_visible.set(True)
+
+        # The first time we see the </SHINYAPP> tag, set the files.
+        if "closed" in events:
+            files = shinyapp_tag_contents_to_filecontents(content)
+            files_in_shinyapp_tags.set(files)
 
     @chat.transform_assistant_response
+    @timed()
     async def transform_response(content: str, chunk: str, done: bool) -> str:
         if done:
-            asyncio.create_task(sync_latest_messages_locked())
-
-        # TODO: This is inefficient because it does this processing for every chunk,
-        # which means it will process the same content multiple times. It would be
-        # better to do this incrementally as the content streams in.
-
-        # Only do this when streaming. (We don't to run it when restoring messages,
-        # which does not use streaming.)
+            schedule_sync_latest_messages()
+            responder.message_done()
         if chunk != "":
-            async with reactive.lock():
-                with reactive.isolate():
-                    # If we see the <SHINYAPP> tag, make sure the shinylive panel is
-                    # visible.
-                    if '<SHINYAPP AUTORUN="1">' in content:
-                        shinylive_panel_visible.set(True)
-
-                        # The first time we see the </SHINYAPP> tag, set the files.
-                        if (
-                            files_in_shinyapp_tags() is None
-                            and "</SHINYAPP>" in content
-                        ):
-                            files = shinyapp_tag_contents_to_filecontents(content)
-                            files_in_shinyapp_tags.set(files)
-
-                        await reactive.flush()
-
-        content = re.sub(
-            '<SHINYAPP AUTORUN="[01]">', "<div class='assistant-shinyapp'>\n", content
-        )
-        content = content.replace(
-            "</SHINYAPP>",
-            "\n<div class='run-code-button-container'>"
-            "<button class='run-code-button btn btn-outline-primary'>Run app →</button>"
-            "</div>\n</div>",
-        )
-        content = re.sub(
-            '\n<FILE NAME="(.*?)">',
-            r"\n<div class='assistant-shinyapp-file'>\n<div class='filename'>\1</div>\n\n```",
-            content,
-        )
-        content = content.replace("\n</FILE>", "\n```\n</div>")
+            # A session that is receiving a response is active, even if the user
+            # hasn't done anything since sending the message.
+            memory_tracker.touch(session.id)
 
-        return content
+        return await transform_response_chunk(
+            shinyapp_tracker, content, chunk, on_shinyapp_tags
+        )
 
     @reactive.effect
     @reactive.event(files_in_shinyapp_tags)
+    @timed()
     async def _send_shinyapp_code():
         # If in the process of restoring from a previous session, don't send the
         # code automatically.
         if restoring:
             return
-        if files_in_shinyapp_tags() is None:
+        files = files_in_shinyapp_tags()
+        if files is None:
             return
-        await session.send_custom_message(
-            "set-shinylive-content", {"files": files_in_shinyapp_tags()}
+        # Validation happens in a separate task, so that this effect (and the
+        # reactive flush that's running it) doesn't wait for it.
+        responder.check_app(files, language())
+
+    # Large and binary files are served from a per-session HTTP route, rather than
+    # being sent inline over the websocket.
+    file_assets = SessionAssetStore(session.dynamic_route)
+
+    # The files that were last sent to the shinylive panel. Only the files that
+    # changed since then are sent.
+    file_sync = FileSetSync(externalize=file_assets.externalize_all)
+
+    async def send_shinyapp_files(files: list[FileContent]):
+        message = file_sync.update(files)
+        memory_tracker.update(
+            session.id, files=files, asset_bytes=file_assets.total_bytes
         )
+        await session.send_custom_message("set-shinylive-content", dict(message))
+
+    @reactive.effect
+    @reactive.event(input.shinylive_files_resync)
+    async def _resync_shinyapp_files():
+        # The client couldn't apply an update, or fetch one of its files, so send
+        # it everything.
+        message = file_sync.resync()
+        memory_tracker.update(session.id, asset_bytes=file_assets.total_bytes)
+        await session.send_custom_message("set-shinylive-content", dict(message))
+
+    # ==================================================================================
+    # Streaming responses into the chat, and checking the apps in them
+    # ==================================================================================
+
+    async def read_chat_messages() -> tuple[MessageParam, ...]:
+        async with reactive.lock():
+            with reactive.isolate():
+                return chat.messages(  # pyright: ignore[reportUnknownMemberType]
+                    format="anthropic"
+                )
+
+    async def show_chat_error(e: Exception):
+        await chat._raise_exception(e)
+
+    def reset_shinyapp_tags():
+        nonlocal shinyapp_tracker
+        files_in_shinyapp_tags.set(None)
+        shinyapp_tracker = ShinyappStreamTracker()
+
+    # Streams the model's responses into the chat, and checks and repairs the apps
+    # in them.
+    responder = ChatResponder(
+        chat,
+        session.id,
+        read_messages=read_chat_messages,
+        send_files=send_shinyapp_files,
+        show_error=show_chat_error,
+        on_response_start=reset_shinyapp_tags,
+        state=shared_state,
+        rate_limit_per_minute=rate_limit_per_minute,
+    )
+
+    # ==================================================================================
+    # Current contents of the shinylive editor
+    # ==================================================================================
+
+    # The client pushes changes to the editor contents in the background, as the
+    # files that were added or changed, and the names of files that were removed.
+    editor_files_by_name: dict[str, FileContent] = {}
+    editor_file_names: list[str] = []
+
+    # The client sends the last delta right before a message, possibly in the same
+    # batch of inputs, so this must run before _send_user_message.
+    @reactive.effect(priority=1)
+    @reactive.event(input.editor_files_delta)
+    def _update_editor_files():
+        nonlocal editor_file_names
+        delta = input.editor_files_delta()
+        for name in delta["removed"]:
+            editor_files_by_name.pop(name, None)
+        for file in delta["changed"]:
+            editor_files_by_name[file["name"]] = file
+        editor_file_names = [
+            name for name in delta["names"] if name in editor_files_by_name
+        ]
+        memory_tracker.touch(session.id)
+        memory_tracker.update(session.id, files=editor_files())
+
+    def editor_files() -> list[FileContent]:
+        return [editor_files_by_name[name] for name in editor_file_names]
 
     @reactive.effect
     @reactive.event(input.show_shinylive)
@@ -521,7 +585,7 @@ did not ask you to modify the code, then ignore the code.
     # Misc utility functions
     # ==================================================================================
     @reactive.calc
-    def language():
+    def language() -> Literal["r", "python"]:
         if input.language_switch() == False:
             return "r"
         else:
@@ -529,6 +593,7 @@ did not ask you to modify the code, then ignore the code.
 
     last_message_sent = 0
 
+    @timed()
     async def sync_latest_messages():
         nonlocal last_message_sent
 
@@ -540,6 +605,9 @@ did not ask you to modify the code, then ignore the code.
                 transform_assistant=False,
             )
 
+        memory_tracker.touch(session.id)
+        memory_tracker.update(session.id, messages=messages)
+
         new_messages = messages[last_message_sent:]
         last_message_sent = len(messages)
         if len(new_messages) > 0:
@@ -549,135 +617,6 @@ did not ask you to modify the code, then ignore the code.
             )
 
 
-def shinyapp_tag_contents_to_filecontents(input: str) -> list[FileContent]:
-    """
-    Extracts the files and their contents from the <SHINYAPP>...</SHINYAPP> tags in the
-    input string.
-    """
-    # Keep the text between the SHINYAPP tags
-    shinyapp_code = re.sub(
-        r".*<SHINYAPP AUTORUN=\"[01]\">(.*)</SHINYAPP>.*",
-        r"\1",
-        input,
-        flags=re.DOTALL,
-    )
-    if shinyapp_code.startswith("\n"):
-        shinyapp_code = shinyapp_code[1:]
-
-    # Find each <FILE NAME="...">...</FILE> tag and extract the contents and file name
-    file_contents: list[FileContent] = []
-    for match in re.finditer(r"<FILE NAME=\"(.*?)\">(.*?)</FILE>", input, re.DOTALL):
-        name = match.group(1)
-        content = match.group(2)
-        if content.startswith("\n"):
-            content = content[1:]
-        file_contents.append({"name": name, "content": content, "type": "text"})
-
-    return file_contents
-
-
-# Remove any consecutive user or assistant messages. Only keep the last one in a
-# sequence. For example, if there are multiple user messages in a row, only keep the
-# last one. This is helpful for when the user sends multiple messages in a row, which
-# can happen if there was an error handling the previous message.
-def remove_consecutive_messages(
-    messages: tuple[MessageParam, ...],
-) -> tuple[MessageParam, ...]:
-    if len(messages) < 2:
-        return messages
-
-    new_messages: list[MessageParam] = []
-    for i in range(len(messages) - 1):
-        if messages[i]["role"] != messages[i + 1]["role"]:
-            new_messages.append(messages[i])
-
-    new_messages.append(messages[-1])
-
-    return tuple(new_messages)
-
-
-# Normalize messages so that insteaed of content being a string, it is a
-# dictionary with "role" and "content" keys. This is so that the format
-# is stable
-def normalize_messages(
-    messages: tuple[MessageParam, ...],
-) -> tuple[MessageParam2, ...]:
-    normalized_messages: list[MessageParam2] = []
-    for msg in messages:
-        content = msg["content"]
-        if isinstance(content, str):
-            normalized_messages.append(
-                {"role": "user", "content": [{"type": "text", "text": content}]}
-            )
-        else:
-            if "role" not in msg or "content" not in msg:
-                raise ValueError(
-                    "Message must be a dictionary with 'role' and 'content' keys."
-                )
-            new_msg: MessageParam2 = msg.copy()  # pyright: ignore[reportAssignmentType]
-            normalized_messages.append(new_msg)
-
-    return tuple(normalized_messages)
-
-
-def add_cache_breakpoints_to_messages(
-    messages: list[MessageParam2] | tuple[MessageParam2, ...],
-    max_cache_breakpoints: int = 3,
-) -> tuple[MessageParam2, ...]:
-    """
-    Add cache breakpoints to a list/tuple of messages.
-
-    Parameters
-    ----------
-    messages
-        The messages to transform
-    max_cache_breakpoints
-        Maximum number of user messages to transform. This defaults to 3, because
-        Anthropic's prompt caching only supports 4 total breakpoints, and there is
-        already one in the system prompt.
-
-    Returns
-    -------
-    list[MessageParam2]
-        The transformed messages in prompt caching format
-    """
-    transformed: list[MessageParam2] = []
-    user_messages_transformed = 0
-
-    for msg in reversed(messages):
-        if msg["role"] == "user" and user_messages_transformed < max_cache_breakpoints:
-            content = deepcopy(msg["content"])
-            content_last_part = deepcopy(content[-1])
-            if (
-                content_last_part["type"] == "thinking"
-                or content_last_part["type"] == "redacted_thinking"
-            ):
-                # Can't add cache-control to these blocks
-                ...
-            else:
-                # Mark the last item in the content as ephemeral
-                cache_control: CacheControlEphemeralParam = {"type": "ephemeral"}
-                content_last_part["cache_control"] = cache_control
-
-            content[-1] = content_last_part
-
-            transformed.insert(
-                0,
-                {
-                    "role": "user",
-                    "content": content,
-                },
-            )
-            user_messages_transformed += 1
-        else:
-            # Keep assistant messages as is. We're checking for string content mostly
-            # to make the type checker happy.
-            content = msg["content"]
-            transformed.insert(0, {"role": msg["role"], "content": content})
-
-    return tuple(transformed)
-
-
 # ======================================================================================
 
 
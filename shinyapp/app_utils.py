@@ -24,3 +24,10 @@ def load_dotenv(dotenv_path: os.PathLike[str] = env_file, **kwargs: Any) -> None
             "`pip install python-dotenv`.",
             stacklevel=2,
         )
+
+
+# Read the contents of a file, where the base path defaults to current dir of this file.
+def read_file(filename: Path | str, base_dir: Path = app_dir) -> str:
+    with open(base_dir / filename, "r") as f:
+        res = f.read()
+        return res
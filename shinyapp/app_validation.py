@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+
+from local_types import FileContent
+from process_pool import get_process_pool
+
+# Top-level modules that can be imported in Shinylive without being listed in
+# requirements.txt: packages that are bundled with Shinylive or built for Pyodide.
+# Anything else has to be installable from PyPI as a pure-Python wheel, and listed
+# in requirements.txt.
+SHINYLIVE_PACKAGES = frozenset("""
+    altair anyio appdirs asgiref bokeh bs4 certifi charset_normalizer click
+    contourpy cycler dateutil faicons fonttools great_tables h11 htmltools idna
+    ipyleaflet ipywidgets jinja2 joblib jsonschema kiwisolver linkify_it lxml
+    markdown_it markupsafe matplotlib mdit_py_plugins mdurl micropip narwhals
+    networkx numpy openpyxl packaging palmerpenguins pandas patsy PIL plotly
+    polars pyarrow pyodide pyodide_http pygments pyparsing pytz qrcode regex
+    requests scipy seaborn shapely shiny shinywidgets six sklearn sniffio
+    starlette statsmodels sympy threadpoolctl typing_extensions tzdata uc_micro
+    urllib3 uvicorn websockets xarray xyzservices yaml
+    """.split())
+
+# PyPI distribution names whose import name is different.
+DISTRIBUTION_IMPORT_NAMES = {
+    "beautifulsoup4": "bs4",
+    "pillow": "PIL",
+    "python-dateutil": "dateutil",
+    "pyyaml": "yaml",
+    "scikit-learn": "sklearn",
+    "opencv-python": "cv2",
+}
+
+MAX_CACHE_ENTRIES = 1000
+
+
+def _requirement_import_names(requirements_txt: str) -> set[str]:
+    names: set[str] = set()
+    for line in requirements_txt.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line == "" or line.startswith("-"):
+            continue
+        dist = re.split(r"[\s\[<>=!~;@]", line, maxsplit=1)[0].lower()
+        import_name = DISTRIBUTION_IMPORT_NAMES.get(dist, dist.replace("-", "_"))
+        names.add(import_name)
+    return names
+
+
+def _imported_modules(tree: ast.AST) -> list[tuple[str, int]]:
+    modules: list[tuple[str, int]] = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                modules.append((alias.name.split(".")[0], node.lineno))
+        elif isinstance(node, ast.ImportFrom):
+            # Relative imports refer to files in the app itself.
+            if node.level == 0 and node.module is not None:
+                modules.append((node.module.split(".")[0], node.lineno))
+    return modules
+
+
+def validate_files(files: list[FileContent]) -> list[str]:
+    """
+    Check the Python files of a Shinylive app, returning a list of problems, or an
+    empty list if none were found. This is CPU-bound, so it is run in a process
+    pool by `validate_app()`.
+    """
+    errors: list[str] = []
+
+    local_modules = {
+        os.path.splitext(os.path.basename(f["name"]))[0]
+        for f in files
+        if f["name"].endswith(".py")
+    }
+    requirements = set[str]()
+    for f in files:
+        if os.path.basename(f["name"]) == "requirements.txt":
+            requirements |= _requirement_import_names(f["content"])
+    available = (
+        SHINYLIVE_PACKAGES | set(sys.stdlib_module_names) | local_modules | requirements
+    )
+
+    for f in files:
+        if not f["name"].endswith(".py") or f["type"] != "text":
+            continue
+        try:
+            tree = ast.parse(f["content"], filename=f["name"])
+        except SyntaxError as e:
+            errors.append(f"{f['name']}, line {e.lineno}: SyntaxError: {e.msg}")
+            continue
+
+        for module, lineno in _imported_modules(tree):
+            if module not in available:
+                errors.append(
+                    f"{f['name']}, line {lineno}: `{module}` is not available in "
+                    "Shinylive. If it can be installed from PyPI, add it to "
+                    "requirements.txt; otherwise, don't use it."
+                )
+
+    return errors
+
+
+def _files_hash(files: list[FileContent]) -> str:
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+_cache: OrderedDict[str, list[str]] = OrderedDict()
+
+
+async def validate_app(files: list[FileContent]) -> list[str]:
+    """
+    Validate the files of a Python Shinylive app without blocking the event loop.
+    Results are cached by the hash of the files.
+    """
+    key = _files_hash(files)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    loop = asyncio.get_running_loop()
+    errors = await loop.run_in_executor(get_process_pool(), validate_files, files)
+
+    _cache[key] = errors
+    if len(_cache) > MAX_CACHE_ENTRIES:
+        _cache.popitem(last=False)
+    return errors
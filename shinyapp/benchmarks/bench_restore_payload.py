@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Benchmark the event loop latency seen by other sessions while one session restores
+# a large saved conversation, comparing how the URL hash is decoded:
+#
+# * inline: the old behavior, where parse_qs, base64 and JSON decoding run on the
+#   event loop.
+# * thread: decoding in a thread with asyncio.to_thread(). This helps, but the event
+#   loop still has to wait whenever the thread is inside one of the base64 or JSON
+#   C functions, which hold the GIL for the whole call.
+# * process: the current behavior, decode_restore_hash_async(), which decodes large
+#   payloads in the shared process pool.
+#
+# Each simulated session wakes up every few milliseconds, and records how late it
+# was. That lateness is what every other user in the process would see as added
+# latency, e.g. in their streaming responses.
+#
+# Usage: python benchmarks/bench_restore_payload.py [--mb 4] [--sessions 50]
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads  # noqa: E402
+from payloads import decode_restore_hash, decode_restore_hash_async  # noqa: E402
+
+TICK_SECS = 0.005
+RESTORES = 5
+
+
+def make_hash(mb: float) -> str:
+    message = "Here is the app:\n\n```python\n" + "x = 1\n" * 150 + "```\n"
+    n = int(mb * 1024 * 1024 * 3 / 4 / (len(message) + 40))
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": message}
+        for i in range(n)
+    ]
+    encoded = base64.b64encode(json.dumps(messages).encode("utf-8")).decode("ascii")
+    return "#chat_history=" + quote(encoded)
+
+
+async def session(lags: list[float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK_SECS)
+        lags.append(time.perf_counter() - start - TICK_SECS)
+
+
+async def restore(mode: str, hash: str) -> None:
+    if mode == "inline":
+        decode_restore_hash(hash)
+    elif mode == "thread":
+        await asyncio.to_thread(decode_restore_hash, hash)
+    else:
+        await decode_restore_hash_async(hash)
+
+
+async def run(mode: str, hash: str, n_sessions: int) -> tuple[list[float], float]:
+    # Start the process pool ahead of time, as it would be in a running server.
+    await decode_restore_hash_async("#chat_history=W10%3D" + " " * 300_000)
+
+    lags: list[float] = []
+    stop = asyncio.Event()
+    sessions = [asyncio.create_task(session(lags, stop)) for _ in range(n_sessions)]
+    await asyncio.sleep(0.1)
+    lags.clear()
+
+    restore_secs = 0.0
+    for _ in range(RESTORES):
+        start = time.perf_counter()
+        await restore(mode, hash)
+        restore_secs += (time.perf_counter() - start) / RESTORES
+        # Restores come from different sessions, not back to back.
+        await asyncio.sleep(0.05)
+
+    stop.set()
+    await asyncio.gather(*sessions)
+    return sorted(lags), restore_secs
+
+
+def main(mb: float, n_sessions: int) -> None:
+    hash = make_hash(mb)
+    payloads.MAX_RESTORE_PAYLOAD_BYTES = len(hash) + 1
+    print(f"Restoring a {len(hash) / 1024 / 1024:.1f} MB URL hash {RESTORES} times")
+    print(f"while {n_sessions} other sessions tick every {TICK_SECS * 1000:.0f} ms")
+    print()
+    print(
+        f"{'mode':>8} {'restore ms':>11} {'lag p50 ms':>11} {'lag p99 ms':>11} "
+        f"{'lag max ms':>11}"
+    )
+    for mode in ("inline", "thread", "process"):
+        lags, restore_secs = asyncio.run(run(mode, hash, n_sessions))
+        print(
+            f"{mode:>8} {restore_secs * 1000:>11.1f} "
+            f"{statistics.median(lags) * 1000:>11.2f} "
+            f"{lags[int(len(lags) * 0.99)] * 1000:>11.2f} {lags[-1] * 1000:>11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mb", type=float, default=4)
+    parser.add_argument("--sessions", type=int, default=50)
+    args = parser.parse_args()
+    main(args.mb, args.sessions)
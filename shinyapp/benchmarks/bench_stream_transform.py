@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Benchmark per-chunk latency of the streaming response transform as the number of
+# simultaneous streams grows, comparing:
+#
+# * locked: the old behavior, where every non-empty chunk takes the reactive lock,
+#   which is shared by all sessions, and runs a reactive flush while holding it
+#   once the response has a <SHINYAPP AUTORUN="1"> tag.
+# * transitions: the current behavior, transform_response_chunk() from
+#   shinyapp_tags.py, which the app's transform calls for every chunk. It only
+#   takes the lock when a stream first sees `<SHINYAPP AUTORUN="1">` and its
+#   closing `</SHINYAPP>`.
+#
+# Both use Shiny's real reactive lock and flush. Each stream has the reactive values
+# that the app's transform sets, and effects that depend on them, but there are no
+# sessions, so a flush doesn't have any outputs or other sessions' effects to run.
+# In the app, flushes are slower, and the locked mode waits longer for the lock.
+#
+# Usage: python benchmarks/bench_stream_transform.py [--streams 1,10,50,100,200]
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_types import FileContent  # noqa: E402
+from shinyapp_tags import (  # noqa: E402
+    ShinyappStreamEvent,
+    ShinyappStreamTracker,
+    shinyapp_tag_contents_to_filecontents,
+    shinyapp_tags_to_html,
+    transform_response_chunk,
+)
+
+from shiny import reactive  # noqa: E402
+
+APP_CODE = "\n".join(
+    f"    ui.input_slider('n{i}', 'N{i}', 0, 100, {i})," for i in range(60)
+)
+RESPONSE = f"""Here is an app that does what you asked.
+
+<SHINYAPP AUTORUN="1">
+<FILE NAME="app.py">
+from shiny import App, render, ui
+
+app_ui = ui.page_sidebar(
+{APP_CODE}
+)
+
+def server(input, output, session):
+    pass
+
+app = App(app_ui, server)
+</FILE>
+</SHINYAPP>
+
+The app has a sidebar with sixty sliders.
+"""
+CHUNK_CHARS = 12
+CHUNK_INTERVAL_SECS = 0.01
+
+
+class StreamState:
+    """The reactive state that a session's transform sets, and effects on it."""
+
+    def __init__(self):
+        self.panel_visible = reactive.value(False)
+        self.files = reactive.value[list[FileContent] | None](None)
+        self.files_sent = 0
+
+        @reactive.effect
+        @reactive.event(self.files)
+        def _send_files():
+            if self.files() is not None:
+                self.files_sent += 1
+
+        self._send_files = _send_files
+
+    def on_tags(self, events: list[ShinyappStreamEvent], content: str) -> None:
+        if "opened" in events:
+            self.panel_visible.set(True)
+        if "closed" in events:
+            self.files.set(shinyapp_tag_contents_to_filecontents(content))
+
+
+async def locked_transform(state: StreamState, content: str, chunk: str) -> str:
+    if chunk != "":
+        async with reactive.lock():
+            with reactive.isolate():
+                if '<SHINYAPP AUTORUN="1">' in content:
+                    state.panel_visible.set(True)
+                    if state.files() is None and "</SHINYAPP>" in content:
+                        state.files.set(shinyapp_tag_contents_to_filecontents(content))
+                    await reactive.flush()
+    return shinyapp_tags_to_html(content)
+
+
+async def run_stream(mode: str, latencies: list[float]) -> None:
+    state = StreamState()
+    tracker = ShinyappStreamTracker()
+    content = ""
+    for i in range(0, len(RESPONSE), CHUNK_CHARS):
+        await asyncio.sleep(CHUNK_INTERVAL_SECS)
+        chunk = RESPONSE[i : i + CHUNK_CHARS]
+        content += chunk
+
+        start = time.perf_counter()
+        if mode == "locked":
+            await locked_transform(state, content, chunk)
+        else:
+            await transform_response_chunk(tracker, content, chunk, state.on_tags)
+        latencies.append(time.perf_counter() - start)
+    assert state.files_sent == 1
+
+
+async def run(mode: str, n_streams: int) -> list[float]:
+    latencies: list[float] = []
+    await asyncio.gather(*(run_stream(mode, latencies) for _ in range(n_streams)))
+    return sorted(latencies)
+
+
+# The reactive lock is bound to the event loop that first uses it, so all of the
+# runs share one loop.
+async def main(stream_counts: list[int]) -> None:
+    n_chunks = (len(RESPONSE) + CHUNK_CHARS - 1) // CHUNK_CHARS
+    print(
+        f"{n_chunks} chunks per stream, one every {CHUNK_INTERVAL_SECS * 1000:.0f} ms"
+    )
+    print()
+    print(f"{'streams':>8} {'mode':>12} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for n_streams in stream_counts:
+        for mode in ("locked", "transitions"):
+            latencies = await run(mode, n_streams)
+            p50 = statistics.median(latencies) * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            print(
+                f"{n_streams:>8} {mode:>12} {p50:>8.3f} {p99:>8.3f} "
+                f"{latencies[-1] * 1000:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streams", default="1,10,50,100,200")
+    args = parser.parse_args()
+    asyncio.run(main([int(n) for n in args.streams.split(",")]))
@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, AsyncIterable, Awaitable, Callable, Literal, Protocol, cast
+
+from anthropic import APIStatusError, RateLimitError
+from anthropic.types import MessageParam
+from app_validation import validate_app
+from conversation_log import conversation_logger, message_for_log
+from llm_stream import (
+    CancellableStream,
+    ResponseStats,
+    TurnContext,
+    create_response_stream,
+    stream_with_continuations,
+)
+from local_types import FileContent
+from message_prep import prepare_history, repair_message
+from prompt_cache import prompt_cache_warmer
+from routing import DEFAULT_MODEL, Route
+from shared_state import SharedState
+
+# Number of responses that are currently streaming in this process.
+active_streams = 0
+
+
+def active_stream_count() -> int:
+    return active_streams
+
+
+REPAIR_PREAMBLE = (
+    "_An automated check found problems with the app above. Fixing them..._\n\n"
+)
+
+
+class ChatOutput(Protocol):
+    async def append_message(self, message: Any) -> Any: ...
+
+    async def append_message_stream(self, message: AsyncIterable[Any]) -> Any: ...
+
+
+class ChatResponder:
+    """
+    Streams the model's responses into a session's chat, and checks the apps in
+    them before they are sent to the shinylive panel. If an app has problems, the
+    model is asked to fix them in one more turn.
+
+    This holds the state of the session's current turn, and doesn't read any
+    reactive sources, so it can be used from the chat's extended task, and tested
+    without a session.
+
+    Parameters
+    ----------
+    chat
+        The chat to append messages to.
+    session_id
+        The session's ID, for the conversation log.
+    read_messages
+        Reads the messages in the chat, in the Anthropic format.
+    send_files
+        Sends an app's files to the shinylive panel.
+    show_error
+        Shows an error from the API in the chat.
+    on_response_start
+        Called when a response starts streaming, to reset the state of the response
+        that came before it.
+    state
+        The state shared with the other worker processes, for rate limits and usage.
+    rate_limit_per_minute
+        Maximum number of requests per minute that use the server's API key, across
+        all worker processes. 0 means no limit.
+    """
+
+    def __init__(
+        self,
+        chat: ChatOutput,
+        session_id: str,
+        read_messages: Callable[[], Awaitable[tuple[MessageParam, ...]]],
+        send_files: Callable[[list[FileContent]], Awaitable[None]],
+        show_error: Callable[[Exception], Awaitable[None]],
+        on_response_start: Callable[[], None],
+        state: SharedState,
+        rate_limit_per_minute: int,
+    ):
+        self._chat = chat
+        self._session_id = session_id
+        self._read_messages = read_messages
+        self._send_files = send_files
+        self._show_error = show_error
+        self._on_response_start = on_response_start
+        self._state = state
+        self._rate_limit_per_minute = rate_limit_per_minute
+
+        # The response stream that is currently being appended to the chat, if any.
+        # It is cancelled when the user sends another message or the session ends.
+        self.current_stream: CancellableStream | None = None
+        # The task validating the app in the response that is currently streaming,
+        # if any. It returns the app's files and the problems that were found.
+        self.validation: asyncio.Task[tuple[list[FileContent], list[str]]] | None = None
+        # Whether the automatic repair turn has been used since the last user
+        # message.
+        self.repair_attempted = False
+        # The task running the repair turn, if any.
+        self.repair_task: asyncio.Task[None] | None = None
+        # The turn of the response stream that finished, until the chat has the
+        # complete message. Messages that aren't from the model never set this.
+        self._finished_turn: TurnContext | None = None
+
+    # Forget the previous turn's app, when the user sends a message. Anything the
+    # chat shows before the next response, like an error message, must not start
+    # a repair of that app.
+    def start_user_turn(self) -> None:
+        self.repair_attempted = False
+        self.validation = None
+        self._finished_turn = None
+
+    async def cancel_stream(self, reason: str) -> None:
+        if self.current_stream is not None:
+            await self.current_stream.cancel(reason)
+
+    def _set_current_stream(self, stream: CancellableStream) -> None:
+        self.current_stream = stream
+
+    # Send messages to the LLM and append the response stream into the chat.
+    # `preamble` is text to show at the start of the response message. Returns
+    # whether the response was started.
+    async def stream_response(
+        self,
+        turn: TurnContext,
+        messages: tuple[MessageParam, ...],
+        route: Route,
+        preamble: str = "",
+    ) -> bool:
+        stats = ResponseStats()
+
+        if turn.uses_server_api_key and not await self.acquire_server_api_capacity():
+            return False
+
+        # Create a response message stream
+        try:
+            stream = await create_response_stream(turn, messages, route)
+        except Exception as e:
+            await self.check_for_overload(turn, e)
+            await self._show_error(e)
+            return False
+
+        self._on_response_start()
+        self.validation = None
+        self._finished_turn = None
+        self._set_current_stream(stream)
+
+        # Continuation requests count against the rate limit, like new messages.
+        async def can_continue() -> bool:
+            return (
+                not turn.uses_server_api_key
+                or await self.server_api_capacity_available()
+            )
+
+        async def logging_stream_wrapper():
+            global active_streams
+            if preamble != "":
+                yield preamble
+            active_streams += 1
+            try:
+                async for chunk in stream_with_continuations(
+                    turn,
+                    stream,
+                    messages,
+                    route,
+                    can_continue=can_continue,
+                    on_stream=self._set_current_stream,
+                ):
+                    stats.observe(chunk)
+                    yield chunk
+                self._finished_turn = turn
+            except Exception as e:
+                await self.check_for_overload(turn, e)
+                raise
+            finally:
+                active_streams -= 1
+                stats.finish()
+                await self._record_response(
+                    turn, messages, route, preamble, stream, stats
+                )
+
+        # Append the response stream into the chat
+        await self._chat.append_message_stream(logging_stream_wrapper())
+        return True
+
+    async def _record_response(
+        self,
+        turn: TurnContext,
+        messages: tuple[MessageParam, ...],
+        route: Route,
+        preamble: str,
+        stream: CancellableStream,
+        stats: ResponseStats,
+    ) -> None:
+        if turn.uses_server_api_key:
+            await asyncio.to_thread(
+                self._state.record_usage, route.model, stats.usage()
+            )
+        if prompt_cache_warmer is not None and turn.uses_server_api_key:
+            await prompt_cache_warmer.record_response(
+                turn.language, turn.verbosity, route.model, stats
+            )
+        if conversation_logger is not None:
+            conversation_logger.log(
+                {
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "session": self._session_id,
+                    "model": route.model,
+                    "kind": route.kind,
+                    "max_tokens": route.max_tokens,
+                    "language": turn.language,
+                    "verbosity": turn.verbosity,
+                    "request": message_for_log(messages[-1]),
+                    "response": preamble + stats.text,
+                    "stop_reason": stats.stop_reason,
+                    "cancelled": stream.cancelled,
+                    "usage": stats.usage(),
+                    "time_to_first_token_ms": stats.time_to_first_token_ms,
+                    "duration_ms": stats.duration_ms,
+                }
+            )
+
+    # Check the rate limits for the server's API key. These are shared by all worker
+    # processes, so that when one of them gets a rate limit error, the others stop
+    # sending requests too.
+    async def acquire_server_api_capacity(self) -> bool:
+        if not await self.server_api_capacity_available():
+            await self.show_rate_limit_message()
+            return False
+        return True
+
+    # Like acquire_server_api_capacity(), but without telling the user.
+    async def server_api_capacity_available(self) -> bool:
+        def available() -> bool:
+            return self._state.backoff_remaining("anthropic") <= 0 and (
+                self._rate_limit_per_minute <= 0
+                or self._state.try_acquire("requests", self._rate_limit_per_minute)
+            )
+
+        return await asyncio.to_thread(available)
+
+    async def show_rate_limit_message(self) -> None:
+        await self._chat.append_message(
+            {
+                "role": "assistant",
+                "content": "**Error:** Shiny Assistant has exceeded its Anthropic rate limit. Please try again later, or provide your own Anthropic API key using the gear icon above.",
+            }
+        )
+
+    async def check_for_overload(self, turn: TurnContext, e: Exception) -> None:
+        if isinstance(e, RateLimitError):
+            if turn.uses_server_api_key:
+                await asyncio.to_thread(
+                    self._state.set_backoff, "anthropic", retry_after_secs(e)
+                )
+            await self.show_rate_limit_message()
+        elif isinstance(e, APIStatusError):
+            if e.status_code == 529:
+                await self._chat.append_message(
+                    {
+                        "role": "assistant",
+                        "content": "**Error:** Shiny Assistant's access to Anthropic is currently overloaded. Please try again later, or provide your own Anthropic API key using the gear icon above.",
+                    }
+                )
+
+    # ==================================================================================
+    # Checking generated apps before sending them to the client
+    # ==================================================================================
+
+    # Start checking the files of an app from the response that is streaming, in a
+    # separate task, so that the caller doesn't wait for it. Only Python apps are
+    # checked, and only once per user message: if the repaired app still has
+    # problems, send it anyway.
+    def check_app(self, files: list[FileContent], language: Literal["r", "python"]):
+        check = language == "python" and not self.repair_attempted
+        self.validation = asyncio.create_task(
+            self.validate_and_send_shinyapp_files(files, check)
+        )
+
+    async def validate_and_send_shinyapp_files(
+        self, files: list[FileContent], check: bool
+    ) -> tuple[list[FileContent], list[str]]:
+        errors: list[str] = []
+        if check:
+            try:
+                errors = await validate_app(files)
+            except Exception as e:
+                print(f"Error validating app: {e}")
+
+        if len(errors) == 0:
+            await self._send_files(files)
+        return files, errors
+
+    # Call this when the chat has a complete message. If it's a response from the
+    # model, and its app had problems, this starts the repair turn.
+    def message_done(self) -> None:
+        turn, self._finished_turn = self._finished_turn, None
+        if turn is not None and self.validation is not None:
+            self.repair_task = asyncio.create_task(
+                self.repair_app_if_needed(turn, self.validation)
+            )
+
+    # When a response is finished, if its app had problems, ask the LLM to fix them
+    # in one more turn. The repaired app is sent to the client instead of the broken
+    # one, which saves the user a round trip through the browser.
+    async def repair_app_if_needed(
+        self,
+        turn: TurnContext,
+        validation_task: asyncio.Task[tuple[list[FileContent], list[str]]],
+    ) -> None:
+        files, errors = await validation_task
+        if len(errors) == 0 or self.repair_attempted:
+            return
+        self.repair_attempted = True
+        print(f"Generated app has {len(errors)} problem(s); requesting a repair")
+
+        messages2 = prepare_history(await self._read_messages())
+        ok = await self.stream_response(
+            turn,
+            cast(tuple[MessageParam, ...], (*messages2, repair_message(errors))),
+            Route(kind="edit", model=DEFAULT_MODEL, max_tokens=8000),
+            preamble=REPAIR_PREAMBLE,
+        )
+        if not ok:
+            # Better to show the user the app with problems than no app at all.
+            await self._send_files(files)
+
+
+# How long to wait before retrying after a rate limit error.
+def retry_after_secs(e: RateLimitError) -> float:
+    try:
+        return float(e.response.headers.get("retry-after", "30"))
+    except ValueError:
+        return 30
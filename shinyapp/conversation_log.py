@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import atexit
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from anthropic.types import MessageParam
+
+
+class ConversationLogger:
+    """
+    Logs conversation records to rotating, gzip-compressed JSONL files without
+    blocking the event loop.
+
+    `log()` only puts the record on a bounded queue. A background thread takes
+    records off the queue in batches, serializes them, and writes them. If the writer
+    falls behind and the queue is full, new records are dropped rather than using
+    unbounded memory or making the caller wait. The number of dropped records is
+    written to the log, as a `{"dropped_records": n}` record, so that gaps in the
+    log can be seen.
+    """
+
+    def __init__(
+        self,
+        log_dir: Path,
+        *,
+        max_queue: int = 10000,
+        batch_size: int = 200,
+        flush_interval_secs: float = 2.0,
+        rotate_bytes: int = 64 * 1024 * 1024,
+        rotate_secs: float = 3600,
+    ):
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.flush_interval_secs = flush_interval_secs
+        self.rotate_bytes = rotate_bytes
+        self.rotate_secs = rotate_secs
+        self.dropped = 0
+        # The number of dropped records that has been written to the log.
+        self._dropped_logged = 0
+
+        self._queue: queue.Queue[dict[str, Any] | None] = queue.Queue(max_queue)
+        self._file: gzip.GzipFile | None = None
+        self._file_opened_at = 0.0
+        self._file_bytes = 0
+
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, name="conversation-logger", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls) -> ConversationLogger | None:
+        log_dir = os.environ.get("CONVERSATION_LOG_DIR")
+        if log_dir is None or log_dir == "":
+            return None
+        return cls(Path(log_dir))
+
+    def log(self, record: dict[str, Any]) -> None:
+        """
+        Queue a record to be written. The record must not be modified afterward.
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                print(f"Conversation log queue is full; {self.dropped} records dropped")
+
+    def close(self) -> None:
+        if not self._thread.is_alive():
+            return
+        # Block until there's room for the sentinel, so no records are lost.
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch: list[dict[str, Any]] = []
+            deadline = time.monotonic() + self.flush_interval_secs
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+
+            self._add_dropped_record(batch)
+            if len(batch) > 0:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print(f"Error writing conversation log: {e}")
+
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+    # If records were dropped since the last batch, add a record of how many.
+    def _add_dropped_record(self, batch: list[dict[str, Any]]) -> None:
+        dropped = self.dropped
+        if dropped > self._dropped_logged:
+            batch.append(
+                {
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "dropped_records": dropped - self._dropped_logged,
+                }
+            )
+            self._dropped_logged = dropped
+
+    def _write_batch(self, batch: list[dict[str, Any]]) -> None:
+        lines = [json.dumps(record, default=str) + "\n" for record in batch]
+        data = "".join(lines).encode("utf-8")
+
+        if self._file is None or self._should_rotate():
+            self._open_new_file()
+        assert self._file is not None
+
+        self._file.write(data)
+        # Don't leave the batch sitting in the compressor's buffer.
+        self._file.flush()
+        self._file_bytes += len(data)
+
+    def _should_rotate(self) -> bool:
+        return (
+            self._file_bytes >= self.rotate_bytes
+            or time.monotonic() - self._file_opened_at >= self.rotate_secs
+        )
+
+    def _open_new_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        path = self.log_dir / f"conversations-{timestamp}-{os.getpid()}.jsonl.gz"
+        self._file = gzip.open(path, "ab")
+        self._file_opened_at = time.monotonic()
+        self._file_bytes = 0
+
+
+# Text blocks in logged messages are cut to this length. The last user message
+# includes the contents of the editor files, which don't need to be logged.
+MAX_LOGGED_TEXT_CHARS = 4000
+
+
+# A copy of a message for the log, with long text cut short, and images and
+# documents left out.
+def message_for_log(message: MessageParam) -> dict[str, Any]:
+    content = message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    blocks: list[dict[str, Any]] = []
+    for block in content:
+        block = dict(block)  # pyright: ignore[reportUnknownArgumentType]
+        if block.get("type") == "text":
+            text = str(block.get("text", ""))
+            if len(text) > MAX_LOGGED_TEXT_CHARS:
+                omitted = len(text) - MAX_LOGGED_TEXT_CHARS
+                text = text[:MAX_LOGGED_TEXT_CHARS] + f"... [{omitted} chars omitted]"
+            blocks.append({"type": "text", "text": text})
+        elif "source" in block:
+            blocks.append({"type": block.get("type"), "source": "[omitted]"})
+        else:
+            blocks.append(block)
+    return {"role": message["role"], "content": blocks}
+
+
+conversation_logger = ConversationLogger.from_env()
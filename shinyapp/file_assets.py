@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import hashlib
+import mimetypes
+from collections import OrderedDict
+from typing import Callable
+
+from local_types import FileContent, FileReference
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Text files larger than this are served over HTTP instead of being sent inline in
+# the websocket message. Binary files are always served over HTTP.
+LARGE_FILE_BYTES = 64 * 1024
+
+# Maximum total size of the assets kept for one session. When it's exceeded, the
+# least recently stored assets are dropped. If the client then asks for one of
+# them, it gets a 404, and asks for a resync, which stores the current files again.
+MAX_SESSION_ASSET_BYTES = 64 * 1024 * 1024
+
+
+class SessionAssetStore:
+    """
+    Content-addressed store for a session's large and binary app files.
+
+    Files are served from a per-session HTTP route, keyed by the SHA-256 of their
+    bytes, with headers that let the browser cache them indefinitely. Messages to the
+    client contain a `FileReference` with the URL instead of the file contents, and
+    the client fetches the contents when it needs them.
+    """
+
+    def __init__(
+        self, register_route: Callable[[str, Callable[[Request], Response]], str]
+    ):
+        self._assets: OrderedDict[str, tuple[bytes, str]] = OrderedDict()
+        self._total_bytes = 0
+        self._register_route = register_route
+        self._base_url: str | None = None
+
+    def _url(self, sha256: str) -> str:
+        if self._base_url is None:
+            # Register the route the first time it's needed. The URL includes a
+            # nonce, so it's registered once to keep the URLs stable.
+            self._base_url = self._register_route("assets", self._handle_request)
+        return f"{self._base_url}&sha256={sha256}"
+
+    def _store(self, data: bytes, name: str) -> str:
+        sha256 = hashlib.sha256(data).hexdigest()
+        if sha256 in self._assets:
+            self._assets.move_to_end(sha256)
+            return sha256
+
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self._assets[sha256] = (data, media_type)
+        self._total_bytes += len(data)
+        return sha256
+
+    # Drop the least recently stored assets until the total is under the limit.
+    # The assets in `keep` were just sent to the client, so they're never dropped,
+    # even if they're over the limit on their own.
+    def _evict(self, keep: set[str]) -> None:
+        for sha256 in list(self._assets):
+            if self._total_bytes <= MAX_SESSION_ASSET_BYTES:
+                return
+            if sha256 in keep:
+                continue
+            data, _ = self._assets.pop(sha256)
+            self._total_bytes -= len(data)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def externalize(self, file: FileContent) -> FileContent | FileReference:
+        """
+        If a file is binary or large, store it and return a reference to it;
+        otherwise return the file as-is.
+        """
+        return self.externalize_all([file])[0]
+
+    def externalize_all(
+        self, files: list[FileContent]
+    ) -> list[FileContent | FileReference]:
+        result = [self._externalize(f) for f in files]
+        self._evict(keep={f["sha256"] for f in result if "sha256" in f})
+        return result
+
+    def _externalize(self, file: FileContent) -> FileContent | FileReference:
+        if file["type"] == "binary":
+            try:
+                data = base64.b64decode(file["content"], validate=False)
+            except (binascii.Error, ValueError):
+                # Not valid base64; let the client deal with it as-is.
+                return file
+        elif len(file["content"]) > LARGE_FILE_BYTES:
+            data = file["content"].encode("utf-8")
+        else:
+            return file
+
+        sha256 = self._store(data, file["name"])
+        return {
+            "name": file["name"],
+            "type": file["type"],
+            "url": self._url(sha256),
+            "size": len(data),
+            "sha256": sha256,
+        }
+
+    def _handle_request(self, request: Request) -> Response:
+        sha256 = request.query_params.get("sha256", "")
+        asset = self._assets.get(sha256)
+        if asset is None:
+            return Response("Not found", status_code=404)
+
+        etag = f'"{sha256}"'
+        headers = {
+            # The URL is content-addressed, so the contents never change.
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "ETag": etag,
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        data, media_type = asset
+        return Response(data, media_type=media_type, headers=headers)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Callable, TypedDict
+
+from local_types import FileContent, FileReference
+
+# Version of the "set-shinylive-content" message format. Version 1 messages are
+# `{"files": [...]}`, with the complete set of files.
+FILE_SYNC_PROTOCOL_VERSION = 2
+
+
+class FileSetDiffMessage(TypedDict):
+    version: int
+    # Sequence number of this update, and of the update that it is relative to. If
+    # the client's copy of the files isn't at `base_seq`, it can't apply the diff and
+    # must ask for a full resync.
+    seq: int
+    base_seq: int
+    # Names of all files in the new file set, in order.
+    names: list[str]
+    # Large and binary files may be sent as references, to be fetched over HTTP.
+    added: list[FileContent | FileReference]
+    changed: list[FileContent | FileReference]
+    removed: list[str]
+
+
+def file_hash(file: FileContent) -> str:
+    return hashlib.sha256(
+        (file["type"] + "\0" + file["content"]).encode("utf-8")
+    ).hexdigest()
+
+
+# The default for FileSetSync: send all files inline.
+def send_inline(files: list[FileContent]) -> list[FileContent | FileReference]:
+    return list[FileContent | FileReference](files)
+
+
+class FileSetSync:
+    """
+    Remembers the set of files that was last sent to a client, so that later updates
+    only need to include the files that changed.
+    """
+
+    def __init__(
+        self,
+        externalize: (
+            Callable[[list[FileContent]], list[FileContent | FileReference]] | None
+        ) = None,
+    ):
+        self._externalize = externalize or send_inline
+        self.seq = 0
+        self.files: list[FileContent] = []
+        self._hashes: dict[str, str] = {}
+
+    def update(self, files: list[FileContent]) -> FileSetDiffMessage:
+        hashes = {f["name"]: file_hash(f) for f in files}
+        added = [f for f in files if f["name"] not in self._hashes]
+        changed = [
+            f
+            for f in files
+            if f["name"] in self._hashes
+            and self._hashes[f["name"]] != hashes[f["name"]]
+        ]
+        removed = [name for name in self._hashes if name not in hashes]
+
+        base_seq = self.seq
+        self.seq += 1
+        self.files = files
+        self._hashes = hashes
+
+        return {
+            "version": FILE_SYNC_PROTOCOL_VERSION,
+            "seq": self.seq,
+            "base_seq": base_seq,
+            "names": [f["name"] for f in files],
+            "added": self._externalize(added),
+            "changed": self._externalize(changed),
+            "removed": removed,
+        }
+
+    def resync(self) -> FileSetDiffMessage:
+        """
+        Forget what the client has, and return a message that contains all of the
+        files that were last sent.
+        """
+        files = self.files
+        self._hashes = {}
+        message = self.update(files)
+        # Sequence 0 is the empty file set that every client starts with.
+        message["base_seq"] = 0
+        return message
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Literal
+
+from anthropic import AsyncAnthropic, AsyncStream
+from anthropic.types import MessageParam, RawMessageStreamEvent
+from prompts import Verbosity
+from routing import MAX_CONTINUATIONS, Route, needs_continuation
+
+# Total number of output tokens (at most) that were not generated because streams
+# were cancelled, across all sessions in this process.
+tokens_saved_total = 0
+
+
+@dataclass(frozen=True)
+class TurnContext:
+    """
+    The settings that a turn (a user message and the response to it) uses, read
+    from the session's inputs when the turn starts.
+
+    Responses are streamed in the chat's extended task, where reading reactive
+    sources raises an error, so everything the requests need is captured up front.
+    """
+
+    client: AsyncAnthropic
+    system_prompt: str
+    language: Literal["r", "python"]
+    verbosity: Verbosity
+    uses_server_api_key: bool
+
+
+class CancellableStream:
+    """
+    Wraps an Anthropic response stream so that it can be cancelled from outside the
+    task that is consuming it.
+
+    When cancelled, the upstream HTTP response is closed right away, even if the
+    consumer is waiting on the next chunk, and iteration ends normally so that the
+    chat sees a complete (if truncated) message.
+    """
+
+    def __init__(
+        self, response_stream: AsyncStream[RawMessageStreamEvent], max_tokens: int
+    ):
+        self._stream = response_stream
+        self.max_tokens = max_tokens
+        self.output_tokens = 0
+        self.stop_reason: str | None = None
+        self._text_parts: list[str] = []
+        self.cancelled = False
+        self.finished = False
+        self._output_chars = 0
+        self._cancel_event = asyncio.Event()
+
+    async def cancel(self, reason: str) -> None:
+        global tokens_saved_total
+
+        if self.finished or self.cancelled:
+            return
+        self.cancelled = True
+        self._cancel_event.set()
+        await self._stream.close()
+
+        # The number of tokens the model would still have produced is unknown;
+        # max_tokens minus what was generated so far is an upper bound.
+        tokens_saved = max(self.max_tokens - self.generated_tokens(), 0)
+        tokens_saved_total += tokens_saved
+        print(
+            f"Cancelled response stream ({reason}) after {self.generated_tokens()} "
+            f"output tokens; saved up to {tokens_saved} tokens "
+            f"({tokens_saved_total} total)"
+        )
+
+    # The text generated so far.
+    @property
+    def text(self) -> str:
+        return "".join(self._text_parts)
+
+    # Output tokens generated so far. The API only reports the output token count
+    # at the end of the stream, so before that it is estimated from the text.
+    def generated_tokens(self) -> int:
+        return max(self.output_tokens, self._output_chars // 4)
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        iterator = self._stream.__aiter__()
+        cancel_wait = asyncio.ensure_future(self._cancel_event.wait())
+        emitted_text = False
+        try:
+            while not self.cancelled:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+                await asyncio.wait(
+                    {next_chunk, cancel_wait}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if self.cancelled:
+                    next_chunk.cancel()
+                    break
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+
+                if (
+                    chunk.type == "content_block_delta"
+                    and chunk.delta.type == "text_delta"
+                ):
+                    self._output_chars += len(chunk.delta.text)
+                    self._text_parts.append(chunk.delta.text)
+                    emitted_text = emitted_text or chunk.delta.text != ""
+                elif chunk.type == "message_delta":
+                    self.output_tokens = chunk.usage.output_tokens
+                    self.stop_reason = chunk.delta.stop_reason
+
+                yield chunk
+        except Exception:
+            # Closing the stream out from under the reader can surface as an
+            # httpx error; that's expected when cancelling.
+            if not self.cancelled:
+                raise
+        finally:
+            cancel_wait.cancel()
+            self.finished = True
+
+        # Leave a non-empty assistant message in the chat, so that the next
+        # request to the API doesn't contain an empty assistant turn.
+        if self.cancelled and not emitted_text:
+            yield "_(Response cancelled.)_"
+
+
+# Start a response to `messages`. This doesn't read any reactive sources, so it can
+# be called from the chat's extended task.
+async def create_response_stream(
+    turn: TurnContext, messages: tuple[MessageParam, ...], route: Route
+) -> CancellableStream:
+    response_stream = await turn.client.messages.create(
+        model=route.model,
+        system=[
+            {
+                "type": "text",
+                "text": turn.system_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+        messages=messages,
+        stream=True,
+        max_tokens=route.max_tokens,
+    )
+    return CancellableStream(response_stream, max_tokens=route.max_tokens)
+
+
+# Sent after a response that was cut off, to ask the model for the rest of it. The
+# partial response can't be sent as a prefill for the assistant turn, because not all
+# models support prefilling.
+CONTINUE_PROMPT = (
+    "Your response was cut off because it was too long. Continue exactly where you "
+    "left off, without repeating anything or adding any introduction."
+)
+
+
+# If a response runs out of tokens inside of a <SHINYAPP> tag, ask the model to
+# continue where it left off, in a new turn after the partial response. The chunks
+# of all the streams are yielded in order, so they go into the same chat message.
+# `can_continue` is checked before each continuation request, and `on_stream` is
+# called with each new stream, so that the caller can cancel it.
+async def stream_with_continuations(
+    turn: TurnContext,
+    stream: CancellableStream,
+    messages: tuple[MessageParam, ...],
+    route: Route,
+    can_continue: Callable[[], Awaitable[bool]],
+    on_stream: Callable[[CancellableStream], None],
+) -> AsyncIterator[Any]:
+    partial_response = ""
+    for continuation in range(MAX_CONTINUATIONS + 1):
+        async for chunk in stream:
+            yield chunk
+
+        partial_response += stream.text
+        if (
+            stream.cancelled
+            or continuation == MAX_CONTINUATIONS
+            or not needs_continuation(partial_response, stream.stop_reason)
+        ):
+            return
+
+        if not await can_continue():
+            # A rate limit message can't be appended while this one streams.
+            yield (
+                "\n\n_(The response was cut short, because Shiny Assistant has "
+                "exceeded its Anthropic rate limit.)_"
+            )
+            return
+
+        print("Response truncated inside <SHINYAPP>; requesting continuation")
+        stream = await create_response_stream(
+            turn,
+            (
+                *messages,
+                {"role": "assistant", "content": partial_response},
+                {"role": "user", "content": CONTINUE_PROMPT},
+            ),
+            route,
+        )
+        on_stream(stream)
+
+
+class ResponseStats:
+    """
+    Collects usage and timing for a response, from its stream chunks. If a response
+    is made of several streams (because of continuations), the usage is summed.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.first_token_at: float | None = None
+        self.finished_at: float | None = None
+        self.input_tokens = 0
+        self.cache_creation_input_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.output_tokens = 0
+        self.stop_reason: str | None = None
+        self._text_parts: list[str] = []
+
+    def observe(self, chunk: Any) -> None:
+        if isinstance(chunk, str):
+            return
+        if chunk.type == "message_start":
+            usage = chunk.message.usage
+            self.input_tokens += usage.input_tokens
+            self.cache_creation_input_tokens += usage.cache_creation_input_tokens or 0
+            self.cache_read_input_tokens += usage.cache_read_input_tokens or 0
+        elif chunk.type == "content_block_delta" and chunk.delta.type == "text_delta":
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self._text_parts.append(chunk.delta.text)
+        elif chunk.type == "message_delta":
+            # This is the cumulative output token count for the stream.
+            self.output_tokens += chunk.usage.output_tokens
+            self.stop_reason = chunk.delta.stop_reason
+
+    def finish(self) -> None:
+        self.finished_at = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        return "".join(self._text_parts)
+
+    @property
+    def time_to_first_token_ms(self) -> float | None:
+        if self.first_token_at is None:
+            return None
+        return (self.first_token_at - self.started_at) * 1000
+
+    @property
+    def duration_ms(self) -> float | None:
+        if self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at) * 1000
+
+    def usage(self) -> dict[str, int]:
+        return {
+            "input_tokens": self.input_tokens,
+            "cache_creation_input_tokens": self.cache_creation_input_tokens,
+            "cache_read_input_tokens": self.cache_read_input_tokens,
+            "output_tokens": self.output_tokens,
+        }
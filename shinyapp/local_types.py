@@ -2,10 +2,15 @@ from __future__ import annotations
 
 from typing import Literal, Required, TypedDict
 
-from anthropic.types import (DocumentBlockParam, ImageBlockParam,
-                             RedactedThinkingBlockParam, TextBlockParam,
-                             ThinkingBlockParam, ToolResultBlockParam,
-                             ToolUseBlockParam)
+from anthropic.types import (
+    DocumentBlockParam,
+    ImageBlockParam,
+    RedactedThinkingBlockParam,
+    TextBlockParam,
+    ThinkingBlockParam,
+    ToolResultBlockParam,
+    ToolUseBlockParam,
+)
 
 
 # Version of MessageParam where `content` must be a a list of blocks.
@@ -24,3 +29,18 @@ class MessageParam2(TypedDict, total=False):
     ]
 
     role: Required[Literal["user", "assistant"]]
+
+
+class FileContent(TypedDict):
+    name: str
+    content: str
+    type: Literal["text", "binary"]
+
+
+# A file whose contents are served over HTTP at `url`, instead of being sent inline.
+class FileReference(TypedDict):
+    name: str
+    type: Literal["text", "binary"]
+    url: str
+    size: int
+    sha256: str
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import json
+from copy import deepcopy
+
+from anthropic.types import CacheControlEphemeralParam, MessageParam
+from local_types import MessageParam2
+
+# The steps that turn the chat messages into the messages sent to the model. These
+# are kept separate from app.py so that they can be run offline, without a Shiny
+# session; see scripts/eval_pipeline.py.
+
+
+# The chat history that is sent to the model is limited to the first number of
+# tokens, less the second number, which is left for the response.
+HISTORY_TOKEN_LIMITS = (32000, 6000)
+
+
+# Prepare the chat messages to be sent to the model: trim and normalize them, add
+# cache breakpoints, and add the current app code to the last user message.
+# `editor_files_json` is the editor files, serialized with
+# payloads.editor_files_json(). Returns the messages and the text of the last user
+# message.
+def prepare_messages(
+    messages: tuple[MessageParam, ...],
+    editor_files_json: str,
+) -> tuple[tuple[MessageParam2, ...], str]:
+    messages2 = prepare_history(messages)
+
+    prompt = message_text(messages2[-1])
+
+    # We add this last message part after adding the cache breakpoint,
+    # because this message part will not be used in future message turns.
+    messages2[-1]["content"].append(
+        {
+            "type": "text",
+            "text": f"""
+<CONTEXT>
+The following is the current app code in JSON format. The text that came before this app
+code might ask you to modify the code. If , please modify the code. If the text
+did not ask you to modify the code, then ignore the code.
+
+```
+{editor_files_json}
+```
+</CONTEXT>
+""",
+        }
+    )
+
+    return messages2, prompt
+
+
+# The steps of prepare_messages() that apply to the whole history. The repair turn
+# uses these too, with its own last message.
+def prepare_history(messages: tuple[MessageParam, ...]) -> tuple[MessageParam2, ...]:
+    messages = trim_messages(remove_consecutive_messages(messages))
+    return add_cache_breakpoints_to_messages(normalize_messages(messages))
+
+
+# Rough token estimate, of about four characters per token.
+def approx_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def message_tokens(message: MessageParam) -> int:
+    content = message["content"]
+    if isinstance(content, str):
+        return approx_tokens(content)
+    return approx_tokens(json.dumps(content, default=str))
+
+
+# Drop the oldest messages that don't fit in the token limits. The last message is
+# always kept, and the history starts with a user message, as the API requires.
+def trim_messages(
+    messages: tuple[MessageParam, ...],
+    token_limits: tuple[int, int] = HISTORY_TOKEN_LIMITS,
+) -> tuple[MessageParam, ...]:
+    remaining = token_limits[0] - token_limits[1]
+    start = len(messages) - 1
+    while start > 0:
+        remaining -= message_tokens(messages[start])
+        if remaining - message_tokens(messages[start - 1]) < 0:
+            break
+        start -= 1
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        start += 1
+    return messages[start:]
+
+
+# Get the text of a message, not including any non-text content blocks.
+def message_text(message: MessageParam2) -> str:
+    return "\n".join(
+        block["text"] for block in message["content"] if block["type"] == "text"
+    )
+
+
+# Remove any consecutive user or assistant messages. Only keep the last one in a
+# sequence. For example, if there are multiple user messages in a row, only keep the
+# last one. This is helpful for when the user sends multiple messages in a row, which
+# can happen if there was an error handling the previous message. It also drops a
+# response whose app was repaired, because the repair turn's response follows it as
+# another assistant message.
+def remove_consecutive_messages(
+    messages: tuple[MessageParam, ...],
+) -> tuple[MessageParam, ...]:
+    if len(messages) < 2:
+        return messages
+
+    new_messages: list[MessageParam] = []
+    for i in range(len(messages) - 1):
+        if messages[i]["role"] != messages[i + 1]["role"]:
+            new_messages.append(messages[i])
+
+    new_messages.append(messages[-1])
+
+    return tuple(new_messages)
+
+
+# Normalize messages so that insteaed of content being a string, it is a
+# dictionary with "role" and "content" keys. This is so that the format
+# is stable
+def normalize_messages(
+    messages: tuple[MessageParam, ...],
+) -> tuple[MessageParam2, ...]:
+    normalized_messages: list[MessageParam2] = []
+    for msg in messages:
+        content = msg["content"]
+        if isinstance(content, str):
+            role = "assistant" if msg["role"] == "assistant" else "user"
+            normalized_messages.append(
+                {"role": role, "content": [{"type": "text", "text": content}]}
+            )
+        else:
+            if "role" not in msg or "content" not in msg:
+                raise ValueError(
+                    "Message must be a dictionary with 'role' and 'content' keys."
+                )
+            new_msg: MessageParam2 = msg.copy()  # pyright: ignore[reportAssignmentType]
+            normalized_messages.append(new_msg)
+
+    return tuple(normalized_messages)
+
+
+def add_cache_breakpoints_to_messages(
+    messages: list[MessageParam2] | tuple[MessageParam2, ...],
+    max_cache_breakpoints: int = 3,
+) -> tuple[MessageParam2, ...]:
+    """
+    Add cache breakpoints to a list/tuple of messages.
+
+    Parameters
+    ----------
+    messages
+        The messages to transform
+    max_cache_breakpoints
+        Maximum number of user messages to transform. This defaults to 3, because
+        Anthropic's prompt caching only supports 4 total breakpoints, and there is
+        already one in the system prompt.
+
+    Returns
+    -------
+    list[MessageParam2]
+        The transformed messages in prompt caching format
+    """
+    transformed: list[MessageParam2] = []
+    user_messages_transformed = 0
+
+    for msg in reversed(messages):
+        if msg["role"] == "user" and user_messages_transformed < max_cache_breakpoints:
+            content = deepcopy(msg["content"])
+            content_last_part = deepcopy(content[-1])
+            if (
+                content_last_part["type"] == "thinking"
+                or content_last_part["type"] == "redacted_thinking"
+            ):
+                # Can't add cache-control to these blocks
+                ...
+            else:
+                # Mark the last item in the content as ephemeral
+                cache_control: CacheControlEphemeralParam = {"type": "ephemeral"}
+                content_last_part["cache_control"] = cache_control
+
+            content[-1] = content_last_part
+
+            transformed.insert(
+                0,
+                {
+                    "role": "user",
+                    "content": content,
+                },
+            )
+            user_messages_transformed += 1
+        else:
+            # Keep assistant messages as is. We're checking for string content mostly
+            # to make the type checker happy.
+            content = msg["content"]
+            transformed.insert(0, {"role": msg["role"], "content": content})
+
+    return tuple(transformed)
+
+
+# The user message that asks the model to fix the problems that the automated check
+# found in the app it just wrote.
+def repair_message(errors: list[str]) -> MessageParam2:
+    problems = "\n".join(f"- {error}" for error in errors)
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": f"""
+<CONTEXT>
+An automated check found these problems in the app you just wrote:
+
+{problems}
+
+Fix them, and respond with the complete corrected app in `<SHINYAPP AUTORUN="1">` tags. Keep the explanation to one or two sentences.
+</CONTEXT>
+""",
+            }
+        ],
+    }
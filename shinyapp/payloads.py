@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import os
+from typing import TypedDict
+from urllib.parse import parse_qs
+
+from local_types import FileContent
+from process_pool import get_process_pool
+
+# Payloads larger than this are decoded or serialized in the process pool, so that
+# they don't block the event loop, which is shared by every session in the process.
+# Smaller ones are handled inline, because sending them to another process would
+# cost more than it saves.
+OFFLOAD_THRESHOLD_BYTES = 256 * 1024
+
+
+def _env_bytes(name: str, default: float, unit: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return int(default * unit)
+    return int(float(value) * unit)
+
+
+# Largest URL hash (with the saved conversation and files) that will be restored.
+MAX_RESTORE_PAYLOAD_BYTES = _env_bytes("MAX_RESTORE_PAYLOAD_MB", 8, 1024 * 1024)
+
+# Largest total size of the files in the editor that will be sent to the model with
+# a message.
+MAX_EDITOR_PAYLOAD_BYTES = _env_bytes("MAX_EDITOR_PAYLOAD_KB", 512, 1024)
+
+
+def format_size(n_bytes: int) -> str:
+    if n_bytes >= 1024 * 1024:
+        return f"{n_bytes / (1024 * 1024):.1f} MB"
+    return f"{n_bytes / 1024:.0f} KB"
+
+
+class PayloadTooLarge(ValueError):
+    def __init__(self, what: str, size: int, limit: int):
+        self.size = size
+        self.limit = limit
+        super().__init__(
+            f"The {what} is too large ({format_size(size)}; the limit is "
+            f"{format_size(limit)})."
+        )
+
+
+class RestoredState(TypedDict):
+    messages: list[dict[str, str]]
+    has_files: bool
+
+
+# Decode the state that the client saved in the URL hash before it disconnected.
+def decode_restore_hash(hash: str) -> RestoredState:
+    # Remove leading # from qs, if present
+    if hash.startswith("#"):
+        hash = hash[1:]
+    if hash == "":
+        return {"messages": [], "has_files": False}
+
+    parsed_qs = parse_qs(hash, strict_parsing=True)
+    messages: list[dict[str, str]] = []
+    if "chat_history" in parsed_qs:
+        messages = json.loads(
+            base64.b64decode(parsed_qs["chat_history"][0]).decode("utf-8")
+        )
+    return {
+        "messages": messages,
+        "has_files": "files" in parsed_qs and len(parsed_qs["files"]) > 0,
+    }
+
+
+async def decode_restore_hash_async(hash: str) -> RestoredState:
+    if len(hash) > MAX_RESTORE_PAYLOAD_BYTES:
+        raise PayloadTooLarge(
+            "saved conversation", len(hash), MAX_RESTORE_PAYLOAD_BYTES
+        )
+    if len(hash) <= OFFLOAD_THRESHOLD_BYTES:
+        return decode_restore_hash(hash)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), decode_restore_hash, hash)
+
+
+# The editor files as JSON, as they're sent to the model.
+def editor_files_json(files: list[FileContent]) -> str:
+    return json.dumps(files, indent=2)
+
+
+async def editor_files_json_async(files: list[FileContent]) -> str:
+    size = sum(len(f["name"]) + len(f["content"]) for f in files)
+    if size > MAX_EDITOR_PAYLOAD_BYTES:
+        raise PayloadTooLarge("app code in the editor", size, MAX_EDITOR_PAYLOAD_BYTES)
+    if size <= OFFLOAD_THRESHOLD_BYTES:
+        return editor_files_json(files)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), editor_files_json, files)
@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# A process pool for CPU-bound work that would otherwise block the event loop for
+# every session: checking generated apps, and decoding and serializing large
+# payloads. Threads help less with this work, because much of it runs in C
+# functions that hold the GIL (see benchmarks/bench_restore_payload.py). The pool is
+# shared, so there's one set of worker processes.
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=int(os.environ.get("VALIDATION_WORKERS", "2")),
+            # Don't fork the server process, which has a running event loop.
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import bisect
+import functools
+import inspect
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from types import FrameType
+from typing import Any, Callable, TypeVar
+
+# Instrumentation for finding where the server spends its time. Both parts are off
+# by default, and cost nothing when they're off:
+#
+# * SERVER_TIMING=1 makes the @timed() decorator record a histogram of the run time
+#   of each decorated function. When it's not set, @timed() returns the function
+#   unchanged.
+# * PROFILE_DIR=<dir> installs a SIGUSR1 handler. When the process gets SIGUSR1, a
+#   background thread samples the stacks of all threads for PROFILE_SECONDS (default
+#   30), and writes them in folded format (one line per stack, with a count), which
+#   can be turned into a flame graph with flamegraph.pl, speedscope, or inferno. The
+#   timing histograms are written alongside, if enabled.
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+TIMING_ENABLED = os.environ.get("SERVER_TIMING", "") not in ("", "0")
+
+# Upper bounds of the histogram buckets, in milliseconds.
+BUCKET_BOUNDS_MS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000
+)  # fmt: skip
+
+SAMPLE_INTERVAL_SECS = 0.005
+
+
+class Histogram:
+    def __init__(self):
+        # The last bucket is for anything over the last bound.
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    # Approximate quantile: the upper bound of the bucket it falls in.
+    def quantile(self, q: float) -> float:
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n > 0:
+                return BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else self.max_ms
+        return 0.0
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count > 0 else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": self.max_ms,
+            "buckets": {
+                **{f"le_{b}ms": n for b, n in zip(BUCKET_BOUNDS_MS, self.counts)},
+                "over": self.counts[-1],
+            },
+        }
+
+
+timings: dict[str, Histogram] = {}
+
+
+# Record how long each call to the function takes, in `timings`. For coroutine
+# functions, this is the time until the coroutine finishes, including time spent
+# waiting. Apply this directly to the function, underneath decorators like
+# @reactive.effect.
+def timed(name: str | None = None) -> Callable[[F], F]:
+    def decorator(fn: F) -> F:
+        if not TIMING_ENABLED:
+            return fn
+
+        histogram = timings.setdefault(name or fn.__name__, Histogram())
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.record((time.perf_counter() - start) * 1000)
+
+            return async_wrapper  # pyright: ignore[reportReturnType]
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.record((time.perf_counter() - start) * 1000)
+
+        return wrapper  # pyright: ignore[reportReturnType]
+
+    return decorator
+
+
+def timing_summary() -> dict[str, dict[str, Any]]:
+    return {name: h.summary() for name, h in timings.items()}
+
+
+def _folded_stack(frame: FrameType | None, thread_name: str) -> str:
+    names: list[str] = []
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        names.append(f"{module}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    names.append(thread_name)
+    # Folded stacks go from the root to the leaf, separated by semicolons.
+    return ";".join(reversed(names)).replace(" ", "_")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads from a background thread, and writes them to a
+    file in folded format. Only one capture runs at a time.
+    """
+
+    def __init__(self, output_dir: Path, duration_secs: float):
+        self.output_dir = output_dir
+        self.duration_secs = duration_secs
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> bool:
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._thread = threading.Thread(
+            target=self._capture, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def _capture(self) -> None:
+        own_id = threading.get_ident()
+        stacks: Counter[str] = Counter()
+        samples = 0
+        deadline = time.monotonic() + self.duration_secs
+        while time.monotonic() < deadline:
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            # This is the only way to get the stacks of other threads from Python.
+            # Despite the underscore, it's a documented function of sys.
+            frames = sys._current_frames()  # pyright: ignore[reportPrivateUsage]
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stacks[
+                    _folded_stack(frame, thread_names.get(thread_id, str(thread_id)))
+                ] += 1
+            samples += 1
+            time.sleep(SAMPLE_INTERVAL_SECS)
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        path = self.output_dir / f"profile-{timestamp}-{os.getpid()}.folded"
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote {samples} profile samples to {path}")
+
+        if TIMING_ENABLED:
+            timings_path = path.with_suffix(".timings.json")
+            timings_path.write_text(json.dumps(timing_summary(), indent=2))
+            print(f"Wrote callback timings to {timings_path}")
+
+
+# Install the SIGUSR1 handler, if PROFILE_DIR is set. Call this once, from the main
+# thread, when the app starts.
+def install_profiler_signal_handler() -> SamplingProfiler | None:
+    profile_dir = os.environ.get("PROFILE_DIR")
+    if profile_dir is None or profile_dir == "" or not hasattr(signal, "SIGUSR1"):
+        return None
+
+    profiler = SamplingProfiler(
+        Path(profile_dir), float(os.environ.get("PROFILE_SECONDS", "30"))
+    )
+
+    def handle_signal(signum: int, frame: FrameType | None) -> None:
+        if profiler.start():
+            print(f"Profiling for {profiler.duration_secs}s")
+        else:
+            print("A profile is already being captured")
+
+    try:
+        signal.signal(signal.SIGUSR1, handle_signal)
+    except ValueError:
+        # Signal handlers can only be installed from the main thread.
+        print("Could not install the SIGUSR1 profiler handler; not in the main thread")
+        return None
+    print(f"Send SIGUSR1 to process {os.getpid()} to capture a profile")
+    return profiler
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import statistics
+import time
+from collections import deque
+from typing import Literal, get_args
+
+from anthropic import AsyncAnthropic
+from llm_stream import ResponseStats
+from prompts import Verbosity, build_app_prompt
+from routing import DEFAULT_MODEL
+from shared_state import SharedState, shared_state, worker_id
+
+# Prompt cache entries expire this long after they were last used.
+CACHE_TTL_SECS = 5 * 60
+
+# Refresh a cache entry when it's this close to expiring.
+REFRESH_MARGIN_SECS = 45
+
+CHECK_INTERVAL_SECS = 15
+
+# The worker that holds this lease in the shared state does the warming. If it
+# stops renewing it, another worker takes over.
+LEASE_NAME = "prompt_cache_warmer"
+LEASE_TTL_SECS = 3 * CHECK_INTERVAL_SECS
+
+TRAFFIC_WINDOW_SECS = 60 * 60
+
+# Relative price of cache writes and reads, compared to uncached input tokens.
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+
+LANGUAGES: tuple[Literal["r", "python"], ...] = ("r", "python")
+
+PromptKey = tuple[Literal["r", "python"], Verbosity]
+
+
+def _prompt_key(key: PromptKey) -> str:
+    return f"{key[0]}/{key[1]}"
+
+
+def _requests_key(key: PromptKey) -> str:
+    return f"prompt_requests:{_prompt_key(key)}"
+
+
+class PromptCacheWarmer:
+    """
+    Keeps the API's prompt cache warm for the system prompts.
+
+    There is one system prompt for each language and verbosity, and they're sent
+    with a cache breakpoint, but the cached prefix expires a few minutes after it's
+    last used. This warms all of them when it starts, and afterward sends a minimal
+    request (one output token) shortly before a prompt's cache entry would expire,
+    as long as that prompt has had at least `min_requests_per_hour` user requests
+    in the last hour. Prompts that are too short to be cached by the model aren't
+    warmed.
+
+    The cache is shared by all of the worker processes, so only the worker that
+    holds a lease in the shared state does the warming. Every worker records its
+    users' requests there, so the warming worker knows when each prompt was last
+    used, and how often.
+
+    To tell whether it's worth it, the cost of the warmup requests is logged along
+    with an estimate of the time to first token that it saved: the number of user
+    requests that hit a cache entry that only existed because of a warmup request,
+    times the measured difference in time to first token between requests that did
+    and didn't hit the cache.
+    """
+
+    def __init__(
+        self,
+        min_requests_per_hour: float,
+        state: SharedState,
+        owner: str,
+        model: str = DEFAULT_MODEL,
+        client: AsyncAnthropic | None = None,
+    ):
+        self.min_requests_per_hour = min_requests_per_hour
+        self.state = state
+        self.owner = owner
+        self.model = model
+        self._keys: list[PromptKey] = [
+            (language, verbosity)
+            for language in LANGUAGES
+            for verbosity in get_args(Verbosity)
+        ]
+        # Prompts that a warmup request showed can't be cached.
+        self._uncacheable: set[PromptKey] = set()
+        self._warmed_all = False
+        self._task: asyncio.Task[None] | None = None
+        self._client = client
+
+        self.warmup_requests = 0
+        self.warmup_cost_tokens = 0.0
+        self.kept_alive_hits = 0
+        self._logged_kept_alive_hits = 0
+        self._cached_ttfts: deque[float] = deque(maxlen=500)
+        self._uncached_ttfts: deque[float] = deque(maxlen=500)
+
+    @classmethod
+    def from_env(cls) -> PromptCacheWarmer | None:
+        value = os.environ.get("PROMPT_CACHE_KEEPALIVE_REQUESTS_PER_HOUR")
+        if value is None or value.strip() == "":
+            return None
+        return cls(float(value), shared_state, worker_id)
+
+    # Start warming the cache in the background, if it hasn't been started yet. The
+    # warmup requests use `api_key`, unless a client was given to the constructor.
+    # This must be called from the event loop.
+    def start(self, api_key: str | None) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        if self._client is None:
+            self._client = AsyncAnthropic(api_key=api_key)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # Record a user's request that was sent with the server's API key.
+    async def record_response(
+        self,
+        language: Literal["r", "python"],
+        verbosity: Verbosity,
+        model: str,
+        stats: ResponseStats,
+    ) -> None:
+        key = (language, verbosity)
+        if key not in self._keys or model != self.model:
+            return
+
+        hit = stats.cache_read_input_tokens > 0
+        ttft = stats.time_to_first_token_ms
+        if ttft is not None:
+            (self._cached_ttfts if hit else self._uncached_ttfts).append(ttft)
+
+        # The shared state is compared across processes, so it uses wall clock time.
+        used_at = time.time() - (time.monotonic() - stats.started_at)
+
+        def record() -> tuple[float, bool] | None:
+            self.state.record_event(_requests_key(key), TRAFFIC_WINDOW_SECS)
+            return self.state.record_prompt_use(_prompt_key(key), used_at, False)
+
+        previous = await asyncio.to_thread(record)
+        if hit and previous is not None:
+            last_used, by_warmer = previous
+            if by_warmer and used_at - last_used < CACHE_TTL_SECS:
+                self.kept_alive_hits += 1
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                warmed = await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing the prompt cache: {e}")
+                warmed = False
+            if warmed or self.kept_alive_hits != self._logged_kept_alive_hits:
+                self._log()
+            await asyncio.sleep(CHECK_INTERVAL_SECS)
+
+    # If this worker holds the lease, refresh the cache entries that are about to
+    # expire and are used often enough. The first time it gets the lease, it warms
+    # all of them. Returns whether any were warmed. This is what the background task
+    # runs every CHECK_INTERVAL_SECS.
+    async def refresh(self) -> bool:
+        if not await asyncio.to_thread(
+            self.state.try_acquire_lease, LEASE_NAME, self.owner, LEASE_TTL_SECS
+        ):
+            return False
+        if not self._warmed_all:
+            self._warmed_all = True
+            for key in self._keys:
+                await self._warm(key)
+            return True
+
+        warmed = False
+        for key in self._keys:
+            if key in self._uncacheable:
+                continue
+            last_used = await asyncio.to_thread(
+                self.state.prompt_last_used, _prompt_key(key)
+            )
+            if last_used is None:
+                continue
+            now = time.time()
+            if now - last_used < CACHE_TTL_SECS - REFRESH_MARGIN_SECS:
+                continue
+            if now - last_used >= CACHE_TTL_SECS:
+                # Already expired; it'll be rewritten by the next request.
+                continue
+            requests = await asyncio.to_thread(
+                self.state.event_count, _requests_key(key), TRAFFIC_WINDOW_SECS
+            )
+            if requests < self.min_requests_per_hour:
+                continue
+            await self._warm(key)
+            warmed = True
+        return warmed
+
+    async def _warm(self, key: PromptKey) -> None:
+        assert self._client is not None
+        language, verbosity = key
+        try:
+            response = await self._client.messages.create(
+                model=self.model,
+                system=[
+                    {
+                        "type": "text",
+                        "text": build_app_prompt(language, verbosity),
+                        "cache_control": {"type": "ephemeral"},
+                    }
+                ],
+                messages=[{"role": "user", "content": "."}],
+                max_tokens=1,
+            )
+        except Exception as e:
+            print(f"Error warming prompt cache for {language}/{verbosity}: {e}")
+            return
+
+        usage = response.usage
+        self.warmup_requests += 1
+        self.warmup_cost_tokens += (
+            usage.input_tokens
+            + (usage.cache_creation_input_tokens or 0) * CACHE_WRITE_PRICE
+            + (usage.cache_read_input_tokens or 0) * CACHE_READ_PRICE
+            # Output tokens are priced at about five times input tokens.
+            + usage.output_tokens * 5
+        )
+        if not usage.cache_creation_input_tokens and not usage.cache_read_input_tokens:
+            # Prompts shorter than the model's minimum cacheable length are
+            # silently not cached, so warming them only costs money.
+            print(
+                f"Not warming the prompt cache for {language}/{verbosity}: the "
+                f"prompt ({usage.input_tokens} tokens) is too short to be cached"
+            )
+            self._uncacheable.add(key)
+            return
+        await asyncio.to_thread(
+            self.state.record_prompt_use, _prompt_key(key), time.time(), True
+        )
+
+    def _log(self) -> None:
+        if len(self._cached_ttfts) > 0 and len(self._uncached_ttfts) > 0:
+            cached = statistics.median(self._cached_ttfts)
+            uncached = statistics.median(self._uncached_ttfts)
+            saved = (
+                f"~{self.kept_alive_hits * max(0.0, uncached - cached) / 1000:.1f}s "
+                f"(median TTFT {cached:.0f}ms cached vs {uncached:.0f}ms uncached)"
+            )
+        else:
+            saved = "not measured yet"
+        self._logged_kept_alive_hits = self.kept_alive_hits
+        print(
+            f"Prompt cache warmer: {self.warmup_requests} warmup requests costing "
+            f"~{self.warmup_cost_tokens:.0f} input-token equivalents; "
+            f"{self.kept_alive_hits} user requests hit a kept-alive cache; "
+            f"TTFT saved {saved}"
+        )
+
+
+prompt_cache_warmer = PromptCacheWarmer.from_env()
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from typing import Literal
+
+from app_utils import read_file
+
+Verbosity = Literal["Code only", "Concise", "Verbose"]
+
+app_prompt_template = read_file("app_prompt.md")
+
+app_prompt_language_specific = {
+    "r": read_file("app_prompt_r.md"),
+    "python": read_file("app_prompt_python.md"),
+}
+
+verbosity_instructions: dict[Verbosity, str] = {
+    "Code only": "If you are providing a Shiny app, please provide only the code."
+    " Do not add any other text, explanations, or instructions unless"
+    " absolutely necessary. Do not tell the user how to install Shiny or run"
+    " the app, because they already know that.",
+    "Concise": "Be concise when explaining the code."
+    " Do not tell the user how to install Shiny or run the app, because they"
+    " already know that.",
+    "Verbose": "",  # The default behavior of Claude is to be verbose
+}
+
+
+# The system prompt. This only depends on the language and verbosity, so that it
+# can be cached by the API across users.
+def build_app_prompt(language: Literal["r", "python"], verbosity: Verbosity) -> str:
+    return app_prompt_template.format(
+        language=language,
+        language_specific_prompt=app_prompt_language_specific[language],
+        verbosity=verbosity_instructions[verbosity],
+    )
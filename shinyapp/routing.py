@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Literal
+
+DEFAULT_MODEL = os.environ.get("ANTHROPIC_MODEL", "claude-sonnet-4-6")
+# Model for short conceptual questions, which don't need the larger model.
+QUESTION_MODEL = os.environ.get("ANTHROPIC_QUESTION_MODEL", "claude-haiku-4-5")
+
+# Maximum number of automatic continuation requests for a single response that
+# was cut off inside of a <SHINYAPP> tag.
+MAX_CONTINUATIONS = 2
+
+RequestKind = Literal["question", "edit", "app"]
+
+
+@dataclass(frozen=True)
+class Route:
+    kind: RequestKind
+    model: str
+    max_tokens: int
+
+
+# Words that indicate that the user wants code written or changed.
+_code_request_re = re.compile(
+    r"\b(create|build|make|write|generate|add|change|modify|update|fix|remove|"
+    r"replace|implement|convert|refactor|rewrite)\b",
+    re.IGNORECASE,
+)
+_app_noun_re = re.compile(
+    r"\b(app|application|dashboard|page|ui|plot|chart|table|sidebar|layout)s?\b",
+    re.IGNORECASE,
+)
+_question_re = re.compile(
+    r"^\s*(how|what|why|when|where|which|who|can|could|does|do|is|are|should|"
+    r"explain|tell me|describe)\b",
+    re.IGNORECASE,
+)
+# "Can you make an app..." is phrased as a question but is a request.
+_polite_request_re = re.compile(r"^\s*(can|could|would|will) you\b", re.IGNORECASE)
+
+SHORT_PROMPT_CHARS = 300
+
+
+def classify_request(prompt: str, has_editor_code: bool) -> RequestKind:
+    """
+    Cheap local classification of a user request. This only uses heuristics on the
+    text, so it errs toward "app", which gets the largest budget.
+    """
+    wants_code = _code_request_re.search(prompt) is not None
+    mentions_app = _app_noun_re.search(prompt) is not None
+
+    is_question = (
+        _question_re.match(prompt) is not None
+        and _polite_request_re.match(prompt) is None
+    )
+
+    if has_editor_code and wants_code:
+        return "edit"
+    if is_question and len(prompt) <= SHORT_PROMPT_CHARS:
+        return "question"
+    if wants_code and mentions_app:
+        return "app"
+    if not wants_code and not has_editor_code and len(prompt) <= SHORT_PROMPT_CHARS:
+        return "question"
+    return "app"
+
+
+def route_request(prompt: str, has_editor_code: bool, verbosity: str) -> Route:
+    kind = classify_request(prompt, has_editor_code)
+
+    if kind == "question":
+        # Questions may still include a small example app, so don't starve them.
+        max_tokens = 4000 if verbosity == "Verbose" else 2000
+        return Route(kind=kind, model=QUESTION_MODEL, max_tokens=max_tokens)
+    elif kind == "edit":
+        return Route(kind=kind, model=DEFAULT_MODEL, max_tokens=8000)
+    else:
+        return Route(kind=kind, model=DEFAULT_MODEL, max_tokens=12000)
+
+
+# editor_code is the server's copy of the files in the shinylive editor, which the
+# client keeps up to date in the background. It's empty if there's no panel or the
+# files are all blank.
+def has_editor_code(editor_code: Any) -> bool:
+    if isinstance(editor_code, dict):
+        editor_code = editor_code.get("files", [])  # pyright: ignore
+    if not isinstance(editor_code, list):
+        return False
+    return any(
+        isinstance(f, dict)
+        and str(f.get("content", "")).strip() != ""  # pyright: ignore
+        for f in editor_code  # pyright: ignore[reportUnknownVariableType]
+    )
+
+
+# A response needs a continuation request if it ran out of tokens while inside
+# of a <SHINYAPP> tag, because the app code would otherwise be truncated.
+def needs_continuation(text: str, stop_reason: str | None) -> bool:
+    if stop_reason != "max_tokens":
+        return False
+    return text.rfind("<SHINYAPP") > text.rfind("</SHINYAPP>")
@@ -7,22 +7,19 @@ function chatMessagesContainer() {
 }
 
 Shiny.initializedPromise.then(() => {
-  // When the user clicks on the send button, request the latest version of the files
-  // from the shinylive iframe. This communication is async, so the file contents will
-  // arrive later on the server side than the user chat message.
+  // The editor contents are pushed to the server in the background (see
+  // "Background sync of editor contents" below), so usually the server already has
+  // them. The poll can be up to a few seconds behind, though, e.g. right after an
+  // app was sent to the shinylive panel, so the editor is checked once more before
+  // the message is sent. Only the files that changed are sent then.
   messageTriggerCounter = 0;
-  chatMessagesContainer().addEventListener(
-    "shiny-chat-input-sent",
-    async (e) => {
-      const fileContents = await requestFileContentsFromWindow();
-      Shiny.setInputValue("editor_code", fileContents, {
-        priority: "event",
-      });
-      // This can be removed once we fix
-      // https://github.com/posit-dev/py-shiny/issues/1600
-      Shiny.setInputValue("message_trigger", messageTriggerCounter++);
-    }
-  );
+  chatMessagesContainer().addEventListener("shiny-chat-input-sent", async (e) => {
+    const trigger = messageTriggerCounter++;
+    await flushEditorSync();
+    // This can be removed once we fix
+    // https://github.com/posit-dev/py-shiny/issues/1600
+    Shiny.setInputValue("message_trigger", trigger);
+  });
 
   // Receive custom message with app code and send to the shinylive panel.
   Shiny.addCustomMessageHandler("set-shinylive-content", async (message) => {
@@ -34,8 +31,31 @@ Shiny.initializedPromise.then(() => {
     // await holds up the message handler loop.
     //
     // Instead, we handle the promise without awaiting it directly.
-    ensureShinylivePanel().then(() => {
-      sendFileContentsToWindow(message.files);
+    let files;
+    if (message.version === 2) {
+      files = applyFileSetDiff(message);
+      if (files === null) {
+        return;
+      }
+    } else {
+      files = message.files;
+    }
+    ensureShinylivePanel().then(async () => {
+      let contents;
+      try {
+        contents = await resolveFileContents(files);
+      } catch (e) {
+        if (e instanceof FileAssetNotFoundError) {
+          // The server dropped the file to save memory. A resync stores the
+          // current files again.
+          console.warn(`${e.message}; resyncing`);
+          requestShinyliveFilesResync(message.seq);
+          return;
+        }
+        throw e;
+      }
+      sendFileContentsToWindow(contents);
+      shinyliveShowsMirror = true;
     });
   });
 
@@ -55,6 +75,101 @@ document.addEventListener("click", async (e) => {
   }
 });
 
+// =====================================================================================
+// Mirror of the files the server has sent to the shinylive panel
+// =====================================================================================
+
+// The server only sends the files that were added, changed, or removed since its
+// previous update (protocol version 2). This is the client's copy of the complete
+// file set, which the updates are applied to.
+const shinyliveFileMirror = {
+  seq: 0,
+  files: new Map(),
+};
+
+// Whether the shinylive panel currently has the files in the mirror, as opposed
+// to files from a "Run app" button or a restore.
+let shinyliveShowsMirror = false;
+
+// Apply an update from the server to the mirror, and return the complete list of
+// files, or null if there's nothing new to send to the shinylive panel.
+function applyFileSetDiff(message) {
+  if (message.base_seq === 0) {
+    shinyliveFileMirror.files.clear();
+  } else if (message.base_seq !== shinyliveFileMirror.seq) {
+    // We missed an update, so this one can't be applied. Ask for everything.
+    console.warn(
+      `Can't apply file update ${message.seq} to ${shinyliveFileMirror.seq}; resyncing`
+    );
+    requestShinyliveFilesResync(message.seq);
+    return null;
+  }
+
+  for (const name of message.removed) {
+    shinyliveFileMirror.files.delete(name);
+  }
+  for (const file of [...message.added, ...message.changed]) {
+    shinyliveFileMirror.files.set(file.name, file);
+  }
+  shinyliveFileMirror.seq = message.seq;
+
+  const unchanged =
+    message.added.length === 0 &&
+    message.changed.length === 0 &&
+    message.removed.length === 0;
+  if (unchanged && shinyliveShowsMirror) {
+    // Don't restart the app in the shinylive panel for nothing.
+    return null;
+  }
+
+  return message.names.map((name) => shinyliveFileMirror.files.get(name));
+}
+
+// Ask the server to send the complete file set again.
+function requestShinyliveFilesResync(seq) {
+  Shiny.setInputValue("shinylive_files_resync", seq, { priority: "event" });
+}
+
+class FileAssetNotFoundError extends Error {}
+
+// Contents of files that the server sent as references ({name, type, url, size,
+// sha256}) instead of inline, keyed by sha256. The URLs are content-addressed, so
+// each file only needs to be fetched once.
+const fetchedFileContents = new Map();
+
+// Fetch the contents of any files that were sent as references. Binary file
+// contents are base64 encoded, which is what the shinylive panel expects.
+async function resolveFileContents(files) {
+  return Promise.all(
+    files.map(async (file) => {
+      if (file.url === undefined) {
+        return file;
+      }
+      if (!fetchedFileContents.has(file.sha256)) {
+        const response = await fetch(file.url);
+        if (response.status === 404) {
+          throw new FileAssetNotFoundError(`${file.name} is no longer available`);
+        }
+        if (!response.ok) {
+          throw new Error(`Failed to fetch ${file.name}: ${response.status}`);
+        }
+        let content;
+        if (file.type === "binary") {
+          content = arrayBufferToBase64(await response.arrayBuffer());
+        } else {
+          content = await response.text();
+        }
+        fetchedFileContents.set(file.sha256, content);
+      }
+      return {
+        name: file.name,
+        content: fetchedFileContents.get(file.sha256),
+        type: file.type,
+      };
+    })
+  );
+}
+
 // =====================================================================================
 // Functions for sending/requesting files from shinylive panel
 // =====================================================================================
@@ -66,6 +181,13 @@ function sendThisShinyappToWindow(buttonEl) {
   const fileTags = shinyappTag.querySelectorAll(".assistant-shinyapp-file");
 
   const files = Array.from(fileTags).map((fileTag) => {
+    if (fileTag.dataset.type === "binary") {
+      return {
+        name: fileTag.querySelector(".filename").innerText,
+        content: fileTag.querySelector("pre").textContent.replace(/\s/g, ""),
+        type: "binary",
+      };
+    }
     return {
       name: fileTag.querySelector(".filename").innerText,
       content: fileTag.querySelector("pre").textContent,
@@ -74,6 +196,7 @@ function sendThisShinyappToWindow(buttonEl) {
   });
 
   sendFileContentsToWindow(files);
+  shinyliveShowsMirror = false;
 }
 
 function sendFileContentsToWindow(fileContents) {
@@ -86,7 +209,7 @@ function sendFileContentsToWindow(fileContents) {
   );
 }
 
-async function requestFileContentsFromWindow() {
+async function requestFileContentsFromWindow(timeoutMs = REPLY_TIMEOUT_MS) {
   const shinylivePanel = document.getElementById("shinylive-panel");
   if (shinylivePanel === null) {
     return [];
@@ -94,17 +217,153 @@ async function requestFileContentsFromWindow() {
 
   const reply = await postMessageAndWaitForReply(
     document.getElementById("shinylive-panel").contentWindow,
-    { type: "getFiles" }
+    { type: "getFiles" },
+    timeoutMs
   );
 
   return reply;
 }
 
-function postMessageAndWaitForReply(targetWindow, message) {
-  return new Promise((resolve) => {
+// =====================================================================================
+// Background sync of editor contents
+// =====================================================================================
+
+// The server keeps a copy of the files in the shinylive editor. Changes are pushed
+// to it in the background, so that when the user sends a message, the server can
+// start the request to the LLM right away, instead of waiting for this page to get
+// the files from the shinylive panel.
+//
+// The shinylive panel doesn't report edits, so it's polled, and also checked right
+// away when focus comes back to this page from the panel (which is what happens
+// when the user goes from editing code to typing a message).
+
+const EDITOR_SYNC_POLL_MS = 3000;
+const EDITOR_SYNC_DEBOUNCE_MS = 200;
+const EDITOR_SYNC_TIMEOUT_MS = 2000;
+
+// Hashes of the files the server has, by name
+const editorSyncedHashes = new Map();
+// The sync that is in progress, if any
+let editorSyncPromise = null;
+let editorSyncDebounceTimer = null;
+
+// Fast non-cryptographic string hash (cyrb53)
+function hashString(str) {
+  let h1 = 0xdeadbeef;
+  let h2 = 0x41c6ce57;
+  for (let i = 0; i < str.length; i++) {
+    const ch = str.charCodeAt(i);
+    h1 = Math.imul(h1 ^ ch, 2654435761);
+    h2 = Math.imul(h2 ^ ch, 1597334677);
+  }
+  h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507);
+  h1 ^= Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+  h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507);
+  h2 ^= Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+  return (4294967296 * (2097151 & h2) + (h1 >>> 0)).toString(36);
+}
+
+function syncEditorFiles() {
+  if (editorSyncPromise === null) {
+    editorSyncPromise = doSyncEditorFiles().finally(() => {
+      editorSyncPromise = null;
+    });
+  }
+  return editorSyncPromise;
+}
+
+async function doSyncEditorFiles() {
+  if (!document.getElementById("shinylive-panel")) {
+    return;
+  }
+  try {
+    const reply = await requestFileContentsFromWindow(EDITOR_SYNC_TIMEOUT_MS);
+    if (!reply) {
+      return;
+    }
+    const files = Array.isArray(reply) ? reply : reply.files ?? [];
+
+    const hashes = new Map(
+      files.map((f) => [f.name, hashString(f.type + "\0" + f.content)])
+    );
+    const changed = files.filter(
+      (f) => editorSyncedHashes.get(f.name) !== hashes.get(f.name)
+    );
+    const removed = Array.from(editorSyncedHashes.keys()).filter(
+      (name) => !hashes.has(name)
+    );
+    if (changed.length === 0 && removed.length === 0) {
+      return;
+    }
+
+    Shiny.setInputValue(
+      "editor_files_delta",
+      { names: files.map((f) => f.name), changed: changed, removed: removed },
+      { priority: "event" }
+    );
+    editorSyncedHashes.clear();
+    hashes.forEach((hash, name) => editorSyncedHashes.set(name, hash));
+  } catch (e) {
+    // If the shinylive panel isn't ready yet, it won't reply.
+    if (!(e instanceof ReplyTimeoutError)) {
+      console.error("Failed to sync editor contents", e);
+    }
+  }
+}
+
+function scheduleEditorSync() {
+  clearTimeout(editorSyncDebounceTimer);
+  editorSyncDebounceTimer = setTimeout(() => {
+    editorSyncDebounceTimer = null;
+    syncEditorFiles();
+  }, EDITOR_SYNC_DEBOUNCE_MS);
+}
+
+// Make sure the server has the latest editor contents: wait for the sync in
+// progress, which may have read the editor before its latest changes, and then
+// sync again, instead of waiting for the scheduled sync or the next poll.
+async function flushEditorSync() {
+  clearTimeout(editorSyncDebounceTimer);
+  editorSyncDebounceTimer = null;
+  if (editorSyncPromise !== null) {
+    await editorSyncPromise;
+  }
+  await syncEditorFiles();
+}
+
+// When the user leaves the shinylive panel, this window gets focus back.
+window.addEventListener("focus", scheduleEditorSync);
+
+setInterval(() => {
+  if (document.visibilityState === "visible") {
+    scheduleEditorSync();
+  }
+}, EDITOR_SYNC_POLL_MS);
+
+// How long to wait for a reply from the shinylive panel, e.g. if it's still
+// loading, or was replaced while the message was in flight.
+const REPLY_TIMEOUT_MS = 5000;
+
+class ReplyTimeoutError extends Error {}
+
+function postMessageAndWaitForReply(
+  targetWindow,
+  message,
+  timeoutMs = REPLY_TIMEOUT_MS
+) {
+  return new Promise((resolve, reject) => {
     const channel = new MessageChannel();
 
+    const timer = setTimeout(() => {
+      channel.port1.close();
+      reject(
+        new ReplyTimeoutError(`No reply to ${message.type} after ${timeoutMs}ms`)
+      );
+    }, timeoutMs);
+
     channel.port1.onmessage = (event) => {
+      clearTimeout(timer);
+      channel.port1.close();
       resolve(event.data);
     };
 
@@ -259,6 +518,7 @@ async function restoreFileContents() {
       console.log(`Restoring ${files.length} file(s)`);
     }
     sendFileContentsToWindow(files);
+    shinyliveShowsMirror = false;
   }
 }
 
@@ -295,6 +555,16 @@ function encodeToBase64(str) {
   return btoa(String.fromCharCode.apply(null, uint8Array));
 }
 
+function arrayBufferToBase64(buffer) {
+  const bytes = new Uint8Array(buffer);
+  // Convert in chunks, to avoid exceeding the maximum number of arguments.
+  let binaryString = "";
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    binaryString += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+  }
+  return btoa(binaryString);
+}
+
 function decodeFromBase64(base64) {
   const binaryString = atob(base64);
   const uint8Array = Uint8Array.from(binaryString, (char) =>
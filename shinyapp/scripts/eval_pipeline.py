@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+
+# Replay recorded conversations through the message preparation pipeline (the system
+# prompt, prepare_messages(), request routing, and create_response_stream(), as the
+# app uses them), and report what each conversation would cost. Use this to check
+# the effect of changes to the prompts or the pipeline.
+#
+# Each assistant turn in a conversation is sent with the real Anthropic client to a
+# local fake streaming endpoint, which streams back the recorded response instead of
+# calling the model. The endpoint simulates prompt caching for each conversation: a
+# cache breakpoint whose prefix was seen before in the same conversation is a cache
+# read, and a new one is a cache write. Sharing of the system prompt across
+# conversations isn't modeled, so that each conversation's result is independent of
+# the others. Token counts are estimated from the length of the text.
+#
+# For each conversation, this reports:
+#
+# * input tokens, split into uncached, cache writes, and cache reads
+# * output tokens
+# * the size of the cacheable prefix of the last request
+# * the fraction of input tokens that are cache reads
+# * time spent preparing messages, and time to first token / total time through the
+#   fake endpoint
+#
+# Results are cached in .eval_cache/ by a hash of the pipeline's source files and of
+# the conversation, so a rerun only evaluates conversations whose result could have
+# changed. Use --no-cache to evaluate everything.
+#
+# The corpus is a JSON Lines file, or a directory of them, with one conversation per
+# line:
+#
+#   {"id": "...", "language": "python", "verbosity": "Concise",
+#    "editor_files": [{"name": "app.py", "content": "...", "type": "text"}],
+#    "messages": [{"role": "user", "content": "..."},
+#                 {"role": "assistant", "content": "..."}, ...]}
+#
+# `language`, `verbosity`, and `editor_files` are optional. A small example corpus is
+# in evals/sample_corpus.jsonl.
+#
+# Usage: python scripts/eval_pipeline.py evals/sample_corpus.jsonl [--concurrency N]
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, TypedDict, cast
+
+APP_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(APP_DIR))
+
+import uvicorn  # noqa: E402
+from anthropic import AsyncAnthropic  # noqa: E402
+from anthropic.types import MessageParam  # noqa: E402
+from llm_stream import (  # noqa: E402
+    ResponseStats,
+    TurnContext,
+    create_response_stream,
+)
+from message_prep import (  # noqa: E402
+    approx_tokens,
+    message_text,
+    normalize_messages,
+    prepare_messages,
+)
+from payloads import editor_files_json  # noqa: E402
+from prompts import build_app_prompt  # noqa: E402
+from routing import has_editor_code, route_request  # noqa: E402
+from starlette.applications import Starlette  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import StreamingResponse  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+
+# Bump this when the way results are computed changes, to invalidate cached results.
+EVAL_VERSION = 2
+
+# Files whose contents determine what is sent to the model.
+PIPELINE_FILES = [
+    "llm_stream.py",
+    "message_prep.py",
+    "payloads.py",
+    "prompts.py",
+    "routing.py",
+    "app_prompt.md",
+    "app_prompt_python.md",
+    "app_prompt_r.md",
+]
+
+# Prefixes shorter than this can't be cached by the API.
+MIN_CACHEABLE_TOKENS = 1024
+
+CHUNK_CHARS = 40
+
+
+class ConversationResult(TypedDict):
+    id: str
+    turns: int
+    input_tokens: int
+    cache_creation_input_tokens: int
+    cache_read_input_tokens: int
+    output_tokens: int
+    cacheable_prefix_tokens: int
+    prepare_ms: float
+    time_to_first_token_ms: float
+    duration_ms: float
+
+
+def pipeline_hash() -> str:
+    h = hashlib.sha256(f"eval-version:{EVAL_VERSION}\n".encode("utf-8"))
+    for name in PIPELINE_FILES:
+        path = APP_DIR / name
+        h.update(name.encode("utf-8") + b"\0")
+        if path.exists():
+            h.update(path.read_bytes())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_corpus(path: Path) -> list[dict[str, Any]]:
+    files = sorted(path.glob("*.jsonl")) if path.is_dir() else [path]
+    conversations: list[dict[str, Any]] = []
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if line.strip() == "":
+                    continue
+                conversation = json.loads(line)
+                conversation.setdefault("id", f"{file.stem}:{i + 1}")
+                conversations.append(conversation)
+    return conversations
+
+
+# ======================================================================================
+# Fake streaming endpoint
+# ======================================================================================
+
+
+# Split a request into content blocks, in the order the API sees them, with a flag
+# for whether each block is a cache breakpoint.
+def request_blocks(body: dict[str, Any]) -> list[tuple[Any, bool]]:
+    blocks: list[tuple[Any, bool]] = []
+    for block in body.get("system", []):
+        blocks.append((block, "cache_control" in block))
+    for message in body["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for block in content:
+            blocks.append(
+                ({"role": message["role"], **block}, "cache_control" in block)
+            )
+    return blocks
+
+
+def block_tokens(block: Any) -> int:
+    if block.get("type") == "text":
+        return approx_tokens(block["text"])
+    return approx_tokens(json.dumps(block))
+
+
+class FakeMessagesEndpoint:
+    """
+    A stand-in for the Messages API that streams back a registered response, and
+    reports simulated prompt cache usage.
+    """
+
+    def __init__(self):
+        self.responses: dict[str, str] = {}
+        # Prefix hashes that have been written to the cache, for each conversation.
+        self.caches: dict[str, set[str]] = {}
+        self.app = Starlette(
+            routes=[Route("/v1/messages", self.handle, methods=["POST"])]
+        )
+
+    def usage(self, conversation_id: str, body: dict[str, Any]) -> dict[str, int]:
+        cache = self.caches.setdefault(conversation_id, set())
+        h = hashlib.sha256()
+        total = 0
+        read = 0
+        written = 0
+        for block, is_breakpoint in request_blocks(body):
+            block = {k: v for k, v in block.items() if k != "cache_control"}
+            h.update(json.dumps(block, sort_keys=True).encode("utf-8"))
+            total += block_tokens(block)
+            if not is_breakpoint or total < MIN_CACHEABLE_TOKENS:
+                continue
+            key = h.hexdigest()
+            if key in cache:
+                read = total
+            else:
+                cache.add(key)
+                written = total
+        written = max(0, written - read)
+        return {
+            "input_tokens": total - read - written,
+            "cache_creation_input_tokens": written,
+            "cache_read_input_tokens": read,
+        }
+
+    async def handle(self, request: Request) -> StreamingResponse:
+        body = await request.json()
+        conversation_id = request.headers["x-eval-conversation"]
+        text = self.responses[request.headers["x-eval-response"]]
+        usage = self.usage(conversation_id, body)
+
+        def event(data: dict[str, Any]) -> str:
+            return f"event: {data['type']}\ndata: {json.dumps(data)}\n\n"
+
+        async def events() -> AsyncIterator[str]:
+            yield event(
+                {
+                    "type": "message_start",
+                    "message": {
+                        "id": "msg_eval",
+                        "type": "message",
+                        "role": "assistant",
+                        "model": body["model"],
+                        "content": [],
+                        "stop_reason": None,
+                        "stop_sequence": None,
+                        "usage": {**usage, "output_tokens": 1},
+                    },
+                }
+            )
+            yield event(
+                {
+                    "type": "content_block_start",
+                    "index": 0,
+                    "content_block": {"type": "text", "text": ""},
+                }
+            )
+            for i in range(0, len(text), CHUNK_CHARS):
+                yield event(
+                    {
+                        "type": "content_block_delta",
+                        "index": 0,
+                        "delta": {
+                            "type": "text_delta",
+                            "text": text[i : i + CHUNK_CHARS],
+                        },
+                    }
+                )
+            yield event({"type": "content_block_stop", "index": 0})
+            yield event(
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": approx_tokens(text)},
+                }
+            )
+            yield event({"type": "message_stop"})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# ======================================================================================
+# Replaying conversations
+# ======================================================================================
+
+
+async def evaluate_conversation(
+    conversation: dict[str, Any],
+    client: AsyncAnthropic,
+    endpoint: FakeMessagesEndpoint,
+) -> ConversationResult:
+    language = conversation.get("language", "python")
+    verbosity = conversation.get("verbosity", "Concise")
+    editor_files = conversation.get("editor_files", [])
+    messages: list[MessageParam] = conversation["messages"]
+    system_prompt = build_app_prompt(language, verbosity)
+
+    result: ConversationResult = {
+        "id": conversation["id"],
+        "turns": 0,
+        "input_tokens": 0,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0,
+        "output_tokens": 0,
+        "cacheable_prefix_tokens": 0,
+        "prepare_ms": 0.0,
+        "time_to_first_token_ms": 0.0,
+        "duration_ms": 0.0,
+    }
+
+    for i, message in enumerate(messages):
+        if message["role"] != "assistant" or i == 0:
+            continue
+        response_id = f"{conversation['id']}:{i}"
+        endpoint.responses[response_id] = message_text(
+            normalize_messages((message,))[0]
+        )
+        # The endpoint finds the recorded response by these headers.
+        turn = TurnContext(
+            client=client.with_options(
+                default_headers={
+                    "x-eval-conversation": conversation["id"],
+                    "x-eval-response": response_id,
+                }
+            ),
+            system_prompt=system_prompt,
+            language=language,
+            verbosity=verbosity,
+            uses_server_api_key=False,
+        )
+
+        start = time.perf_counter()
+        prepared, prompt = prepare_messages(
+            tuple(messages[:i]), editor_files_json(editor_files)
+        )
+        route = route_request(
+            prompt=prompt,
+            has_editor_code=has_editor_code(editor_files),
+            verbosity=verbosity,
+        )
+        result["prepare_ms"] += (time.perf_counter() - start) * 1000
+
+        stats = ResponseStats()
+        stream = await create_response_stream(
+            turn, cast(tuple[MessageParam, ...], prepared), route
+        )
+        async for chunk in stream:
+            stats.observe(chunk)
+        stats.finish()
+        del endpoint.responses[response_id]
+
+        result["turns"] += 1
+        result["input_tokens"] += stats.input_tokens
+        result["cache_creation_input_tokens"] += stats.cache_creation_input_tokens
+        result["cache_read_input_tokens"] += stats.cache_read_input_tokens
+        result["output_tokens"] += stats.output_tokens
+        result["time_to_first_token_ms"] += stats.time_to_first_token_ms or 0
+        result["duration_ms"] += stats.duration_ms or 0
+        result["cacheable_prefix_tokens"] = (
+            stats.cache_creation_input_tokens + stats.cache_read_input_tokens
+        )
+
+    return result
+
+
+def conversation_key(pipeline: str, conversation: dict[str, Any]) -> str:
+    data = json.dumps(conversation, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(pipeline.encode("utf-8") + b"\0" + data).hexdigest()
+
+
+async def run(
+    conversations: list[dict[str, Any]], concurrency: int, cache_dir: Path | None
+) -> list[ConversationResult]:
+    pipeline = pipeline_hash()
+    results: dict[str, ConversationResult] = {}
+    to_evaluate: list[tuple[dict[str, Any], str]] = []
+    for conversation in conversations:
+        key = conversation_key(pipeline, conversation)
+        cached = None if cache_dir is None else cache_dir / f"{key}.json"
+        if cached is not None and cached.exists():
+            results[conversation["id"]] = cast(
+                ConversationResult, json.loads(cached.read_text())
+            )
+        else:
+            to_evaluate.append((conversation, key))
+
+    print(
+        f"Pipeline {pipeline[:12]}: {len(results)} cached, "
+        f"{len(to_evaluate)} to evaluate",
+        file=sys.stderr,
+    )
+
+    if len(to_evaluate) > 0:
+        endpoint = FakeMessagesEndpoint()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(endpoint.app, log_level="warning"))
+        server_task = asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started:
+            await asyncio.sleep(0.01)
+
+        client = AsyncAnthropic(api_key="eval", base_url=f"http://127.0.0.1:{port}")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def evaluate(conversation: dict[str, Any], key: str) -> None:
+            async with semaphore:
+                result = await evaluate_conversation(conversation, client, endpoint)
+            results[conversation["id"]] = result
+            if cache_dir is not None:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                (cache_dir / f"{key}.json").write_text(json.dumps(result))
+
+        try:
+            await asyncio.gather(*(evaluate(c, k) for c, k in to_evaluate))
+        finally:
+            await client.close()
+            server.should_exit = True
+            await server_task
+
+    return [results[c["id"]] for c in conversations]
+
+
+def total_result(results: list[ConversationResult]) -> ConversationResult:
+    return {
+        "id": "TOTAL",
+        "turns": sum(r["turns"] for r in results),
+        "input_tokens": sum(r["input_tokens"] for r in results),
+        "cache_creation_input_tokens": sum(
+            r["cache_creation_input_tokens"] for r in results
+        ),
+        "cache_read_input_tokens": sum(r["cache_read_input_tokens"] for r in results),
+        "output_tokens": sum(r["output_tokens"] for r in results),
+        "cacheable_prefix_tokens": sum(r["cacheable_prefix_tokens"] for r in results),
+        "prepare_ms": sum(r["prepare_ms"] for r in results),
+        "time_to_first_token_ms": sum(r["time_to_first_token_ms"] for r in results),
+        "duration_ms": sum(r["duration_ms"] for r in results),
+    }
+
+
+def print_report(results: list[ConversationResult]) -> None:
+    header = (
+        f"{'conversation':<24} {'turns':>5} {'uncached':>9} {'cache wr':>9} "
+        f"{'cache rd':>9} {'output':>7} {'prefix':>7} {'hit %':>6} "
+        f"{'prep ms':>8} {'ttft ms':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+
+    for r in [*results, total_result(results)]:
+        total_input = (
+            r["input_tokens"]
+            + r["cache_creation_input_tokens"]
+            + r["cache_read_input_tokens"]
+        )
+        hit = r["cache_read_input_tokens"] / total_input * 100 if total_input else 0
+        ttft = r["time_to_first_token_ms"] / r["turns"] if r["turns"] else 0
+        if r["id"] == "TOTAL":
+            print("-" * len(header))
+        print(
+            f"{r['id'][:24]:<24} {r['turns']:>5} {r['input_tokens']:>9} "
+            f"{r['cache_creation_input_tokens']:>9} "
+            f"{r['cache_read_input_tokens']:>9} {r['output_tokens']:>7} "
+            f"{r['cacheable_prefix_tokens']:>7} {hit:>6.1f} "
+            f"{r['prepare_ms']:>8.1f} {ttft:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay conversations through the message preparation pipeline."
+    )
+    parser.add_argument("corpus", type=Path, help="JSON Lines file or directory")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--cache-dir", type=Path, default=APP_DIR / ".eval_cache")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run(
+            load_corpus(args.corpus),
+            args.concurrency,
+            None if args.no_cache else args.cache_dir,
+        )
+    )
+    print_report(results)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+        print(f"Wrote {args.json}", file=sys.stderr)
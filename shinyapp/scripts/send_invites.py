@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import argparse
+import contextlib
 import hmac
 import json
 import os
 import re
+import sqlite3
 import sys
+from typing import Any, Sequence
 
 import dotenv
 import markdown
@@ -21,6 +26,7 @@ script_dir = os.path.dirname(__file__)
 parent_dir = os.path.dirname(script_dir)
 token_json_path = os.path.join(script_dir, "token.json")
 template_path = os.path.join(script_dir, "template.md")
+cache_db_path = os.path.join(script_dir, "waitlist.sqlite")
 dotenv.load_dotenv(os.path.join(parent_dir, ".env"))
 
 # Mailgun configuration
@@ -40,7 +46,19 @@ SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
 # The ID and range of the spreadsheet.
 SHEET_ID = "1uXXu3phsi64CtKd52d5NKW5PTS9aBJQbzlp3qsUnGTc"
-SHEET_RANGE = "Form Responses 1!A:H"
+SHEET_NAME = "Form Responses 1"
+SHEET_RANGE = f"{SHEET_NAME}!A:H"
+
+COLUMNS = [
+    "timestamp",
+    "email",
+    "name",
+    "company",
+    "title",
+    "shiny_languages",
+    "anthropic_api_key",
+    "invite_sent",
+]
 
 
 def get_google_sheet_service():
@@ -61,31 +79,85 @@ def get_google_sheet_service():
     return build("sheets", "v4", credentials=creds)
 
 
-def get_sheet_data(service):
+# The sheet's rows are cached in a local SQLite database. Rows are only ever
+# appended to the sheet by the form, so each run only fetches the rows after the
+# last one in the cache. The only column that this script changes is invite_sent;
+# it's updated in the cache and in the sheet together. If the sheet is edited by
+# hand, run with --full-sync to rebuild the cache.
+def open_cache(full_sync: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(cache_db_path)
+    if full_sync:
+        conn.execute("DROP TABLE IF EXISTS responses")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS responses (
+            row_number INTEGER PRIMARY KEY,
+            {", ".join(f"{col} TEXT NOT NULL DEFAULT ''" for col in COLUMNS)}
+        )
+        """)
+    # Partial index for listing pending invites, which is the common query.
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS responses_pending ON responses (row_number) "
+        "WHERE invite_sent != 'Yes'"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS responses_email ON responses (email COLLATE NOCASE)"
+    )
+    conn.commit()
+    return conn
+
+
+# Fetch the rows that were appended to the sheet since the last sync, and add them
+# to the cache. Returns the number of new rows, or None if there was an error.
+def sync_sheet_data(service, conn: sqlite3.Connection) -> int | None:
+    # Row 1 is the header, so the first data row is row 2.
+    last_row = conn.execute(
+        "SELECT COALESCE(MAX(row_number), 1) FROM responses"
+    ).fetchone()[0]
     try:
         result = (
             service.spreadsheets()
             .values()
-            .get(spreadsheetId=SHEET_ID, range=SHEET_RANGE)
+            .get(spreadsheetId=SHEET_ID, range=f"{SHEET_NAME}!A{last_row + 1}:H")
             .execute()
         )
-        values = result.get("values", [])
-        df = pd.DataFrame(values[1:], columns=values[0])
-        df.columns = [
-            "timestamp",
-            "email",
-            "name",
-            "company",
-            "title",
-            "shiny_languages",
-            "anthropic_api_key",
-            "invite_sent",
-        ]
-        return df
     except HttpError as error:
         print(f"An error occurred: {error}")
         return None
 
+    values = result.get("values", [])
+    rows = [
+        # The API leaves out empty cells at the end of a row.
+        (last_row + 1 + i, *(row + [""] * (len(COLUMNS) - len(row)))[: len(COLUMNS)])
+        for i, row in enumerate(values)
+    ]
+    with conn:
+        conn.executemany(
+            f"INSERT INTO responses (row_number, {', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(COLUMNS) + 1))})",
+            rows,
+        )
+    if rows:
+        print(f"Fetched {len(rows)} new rows from the sheet.")
+    return len(rows)
+
+
+def query_responses(
+    conn: sqlite3.Connection,
+    where: str,
+    params: Sequence[Any] = (),
+    limit: int | None = None,
+) -> pd.DataFrame:
+    sql = f"SELECT * FROM responses WHERE {where} ORDER BY row_number"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    return pd.read_sql_query(sql, conn, params=params, index_col="row_number")
+
+
+def pending_responses(
+    conn: sqlite3.Connection, limit: int | None = None
+) -> pd.DataFrame:
+    return query_responses(conn, "invite_sent != 'Yes'", limit=limit)
+
 
 def read_email_template():
     try:
@@ -144,30 +216,43 @@ def send_bulk_emails(recipients_df):
     return successful_emails
 
 
-def update_sheet(service, sent_emails):
+# Mark the rows for the sent emails as invited, writing only the changed cells to
+# the sheet. The cache is only updated if the sheet was updated. Emails are
+# matched without regard to case, as when looking up a single email.
+def update_sheet(service, conn: sqlite3.Connection, sent_emails: list[str]) -> None:
+    placeholders = ", ".join("?" * len(sent_emails))
+    row_numbers = [
+        row_number
+        for (row_number,) in conn.execute(
+            f"SELECT row_number FROM responses "
+            f"WHERE email COLLATE NOCASE IN ({placeholders}) "
+            f"AND invite_sent != 'Yes'",
+            sent_emails,
+        )
+    ]
+    if not row_numbers:
+        print("No updates needed.")
+        return
+
+    updates = [
+        {"range": f"{SHEET_NAME}!H{row_number}", "values": [["Yes"]]}
+        for row_number in row_numbers
+    ]
     try:
-        df = get_sheet_data(service)
-        df.loc[
-            df["email"].isin(sent_emails) & (df["invite_sent"] != "Yes"), "invite_sent"
-        ] = "Yes"
-
-        updates = []
-        for index, row in df.iterrows():
-            if row["email"] in sent_emails and row["invite_sent"] == "Yes":
-                updates.append(
-                    {"range": f"Form Responses 1!H{index + 2}", "values": [["Yes"]]}
-                )
-
-        if updates:
-            body = {"valueInputOption": "RAW", "data": updates}
-            service.spreadsheets().values().batchUpdate(
-                spreadsheetId=SHEET_ID, body=body
-            ).execute()
-            print(f"Sheet updated for {len(updates)} rows.")
-        else:
-            print("No updates needed.")
+        body = {"valueInputOption": "RAW", "data": updates}
+        service.spreadsheets().values().batchUpdate(
+            spreadsheetId=SHEET_ID, body=body
+        ).execute()
     except HttpError as error:
         print(f"An error occurred while updating the sheet: {error}")
+        return
+
+    with conn:
+        conn.executemany(
+            "UPDATE responses SET invite_sent = 'Yes' WHERE row_number = ?",
+            [(row_number,) for row_number in row_numbers],
+        )
+    print(f"Sheet updated for {len(updates)} rows.")
 
 
 def is_valid_email(email):
@@ -175,13 +260,8 @@ def is_valid_email(email):
     return email_regex.match(email) is not None
 
 
-def process_single_email(service, email):
-    df = get_sheet_data(service)
-    if df.empty:
-        print("No data found in the sheet.")
-        return
-
-    row = df[df["email"].str.lower() == email.lower()]
+def process_single_email(service, conn: sqlite3.Connection, email: str) -> None:
+    row = query_responses(conn, "email = ? COLLATE NOCASE", (email,), limit=1)
     if not row.empty:
         if row["invite_sent"].values[0] == "Yes":
             print(f"An invite has already been sent to {email}.")
@@ -189,7 +269,7 @@ def process_single_email(service, email):
             recipients = row[["name", "email"]]
             sent_emails = send_bulk_emails(recipients)
             if sent_emails:
-                update_sheet(service, sent_emails)
+                update_sheet(service, conn, sent_emails)
                 print(f"Invite sent to {email}.")
             else:
                 print(f"Failed to send invite to {email}.")
@@ -197,8 +277,8 @@ def process_single_email(service, email):
         print(f"Email address {email} not found in the sheet.")
 
 
-def print_pending_invites(df):
-    pending_invites = df[df["invite_sent"] != "Yes"].drop(columns=["invite_sent"])
+def print_pending_invites(conn: sqlite3.Connection) -> None:
+    pending_invites = pending_responses(conn).drop(columns=["invite_sent"])
     if not pending_invites.empty:
         print("Pending invites:")
         print(pending_invites)
@@ -214,33 +294,34 @@ def create_signed_url(email):
     return f"https://gallery.shinyapps.io/assistant/?email={email}&sig={sig}"
 
 
-def main(arg=None):
+def main(arg=None, full_sync: bool = False):
     service = get_google_sheet_service()
-    df = get_sheet_data(service)
-
-    if df is None or df.empty:
-        print("No data found.")
-        return
-
-    try:
-        if arg is None:
-            print_pending_invites(df)
-        elif isinstance(arg, str) and is_valid_email(arg):
-            process_single_email(service, arg)
-        else:
-            max_recipients = arg
-            recipients = df[(df["invite_sent"] != "Yes")].head(max_recipients)
-            if not recipients.empty:
-                sent_emails = send_bulk_emails(recipients)
-                if sent_emails:
-                    update_sheet(service, sent_emails)
-                else:
-                    print("No emails were sent successfully.")
+    with contextlib.closing(open_cache(full_sync)) as conn:
+        if sync_sheet_data(service, conn) is None:
+            return
+        if conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 0:
+            print("No data found.")
+            return
+
+        try:
+            if arg is None:
+                print_pending_invites(conn)
+            elif isinstance(arg, str) and is_valid_email(arg):
+                process_single_email(service, conn, arg)
             else:
-                print("No recipients found to email.")
+                max_recipients = arg
+                recipients = pending_responses(conn, limit=max_recipients)
+                if not recipients.empty:
+                    sent_emails = send_bulk_emails(recipients)
+                    if sent_emails:
+                        update_sheet(service, conn, sent_emails)
+                    else:
+                        print("No emails were sent successfully.")
+                else:
+                    print("No recipients found to email.")
 
-    except HttpError as err:
-        print(f"An error occurred: {err}")
+        except HttpError as err:
+            print(f"An error occurred: {err}")
 
 
 if __name__ == "__main__":
@@ -252,14 +333,19 @@ if __name__ == "__main__":
         nargs="?",
         help="Either the maximum number of recipients to email or a single email address. If not provided, lists pending invites.",
     )
+    parser.add_argument(
+        "--full-sync",
+        action="store_true",
+        help="Rebuild the local cache of the sheet from scratch. Use this if the sheet was edited by hand.",
+    )
     args = parser.parse_args()
 
     if args.arg is None:
-        main()
+        main(full_sync=args.full_sync)
     elif args.arg.isdigit():
-        main(int(args.arg))
+        main(int(args.arg), full_sync=args.full_sync)
     elif is_valid_email(args.arg):
-        main(args.arg)
+        main(args.arg, full_sync=args.full_sync)
     else:
         print(
             "Invalid argument. Please provide either a number, a valid email address, or no argument to list pending invites."
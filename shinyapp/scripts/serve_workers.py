@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Run the app in several worker processes behind a small reverse proxy, to use more
+# than one CPU core.
+#
+# Each browser is pinned to one worker with a cookie that holds a random token. The
+# token is mapped to a worker with rendezvous hashing, so a browser's HTTP requests,
+# websocket, and reconnects all go to the same worker, which has its session state
+# in memory. If a worker goes away, only the browsers that were on it move. When a
+# new browser arrives, two candidate tokens are drawn and the one whose worker is
+# less loaded is used.
+#
+# The workers share rate limits, API backoff, and usage counters through a SQLite
+# database (SHARED_STATE_DB; see shared_state.py), and report their load to it.
+# The reported loads can be seen at /__workers.
+#
+# Usage: python scripts/serve_workers.py [--workers N] [--port 8000]
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator
+
+APP_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(APP_DIR))
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+import websockets  # noqa: E402
+from starlette.applications import Starlette  # noqa: E402
+from starlette.background import BackgroundTask  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import JSONResponse, Response, StreamingResponse  # noqa: E402
+from starlette.routing import Route, WebSocketRoute  # noqa: E402
+from starlette.websockets import WebSocket, WebSocketDisconnect  # noqa: E402
+from websockets.typing import Subprotocol  # noqa: E402
+
+AFFINITY_COOKIE = "shinyapp_worker"
+
+# Headers that apply to a single connection, and must not be forwarded.
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+# Headers of the websocket handshake. The connection to the worker has its own
+# handshake, so these aren't forwarded; the subprotocols are negotiated separately.
+WEBSOCKET_HANDSHAKE_HEADERS = {
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+    "sec-websocket-accept",
+}
+
+
+class Worker:
+    def __init__(self, worker_id: str, port: int, env: dict[str, str]):
+        self.worker_id = worker_id
+        self.port = port
+        self.env = env
+        self.process: subprocess.Popen[bytes] | None = None
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "app:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+            ],
+            cwd=APP_DIR,
+            env={**self.env, "WORKER_ID": self.worker_id},
+        )
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+
+def rendezvous_score(token: str, worker_id: str) -> int:
+    digest = hashlib.sha256(f"{token}\0{worker_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class WorkerProxy:
+    def __init__(self, workers: list[Worker]):
+        self.workers = workers
+        self.client = httpx.AsyncClient(timeout=None)
+        self.app = Starlette(
+            routes=[
+                Route("/__workers", self.status),
+                WebSocketRoute("/{path:path}", self.proxy_websocket),
+                Route(
+                    "/{path:path}",
+                    self.proxy_http,
+                    methods=["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE"],
+                ),
+            ],
+            lifespan=self.lifespan,
+        )
+        # Imported here so that SHARED_STATE_DB is set first.
+        from shared_state import shared_state
+
+        self.shared_state = shared_state
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self, app: Starlette) -> AsyncIterator[None]:
+        yield
+        await self.client.aclose()
+
+    def worker_for(self, token: str) -> Worker:
+        candidates = [w for w in self.workers if w.alive] or self.workers
+        return max(candidates, key=lambda w: rendezvous_score(token, w.worker_id))
+
+    async def new_token(self) -> str:
+        loads = await asyncio.to_thread(self.shared_state.worker_loads)
+
+        def load(token: str) -> tuple[int, int]:
+            report = loads.get(self.worker_for(token).worker_id)
+            if report is None:
+                return (0, 0)
+            return (report["active_streams"], report["sessions"])
+
+        return min((secrets.token_urlsafe(16) for _ in range(2)), key=load)
+
+    async def status(self, request: Request) -> JSONResponse:
+        loads = await asyncio.to_thread(self.shared_state.worker_loads)
+        usage = await asyncio.to_thread(self.shared_state.usage)
+        return JSONResponse(
+            {
+                "workers": [
+                    {
+                        "worker_id": w.worker_id,
+                        "port": w.port,
+                        "alive": w.alive,
+                        "load": loads.get(w.worker_id),
+                    }
+                    for w in self.workers
+                ],
+                "usage_today": usage,
+            }
+        )
+
+    async def proxy_http(self, request: Request) -> Response:
+        token = request.cookies.get(AFFINITY_COOKIE)
+        new_token = token is None
+        if token is None:
+            token = await self.new_token()
+        worker = self.worker_for(token)
+
+        url = httpx.URL(
+            f"http://127.0.0.1:{worker.port}{request.url.path}",
+            query=request.url.query.encode("utf-8"),
+        )
+        headers = [
+            (k, v) for k, v in request.headers.items() if k not in HOP_BY_HOP_HEADERS
+        ]
+        upstream_request = self.client.build_request(
+            request.method, url, headers=headers, content=request.stream()
+        )
+        try:
+            upstream = await self.client.send(upstream_request, stream=True)
+        except httpx.HTTPError as e:
+            return Response(f"Worker unavailable: {e}", status_code=502)
+
+        response = StreamingResponse(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers={
+                k: v
+                for k, v in upstream.headers.items()
+                if k.lower() not in HOP_BY_HOP_HEADERS
+            },
+            background=BackgroundTask(upstream.aclose),
+        )
+        if new_token:
+            response.set_cookie(AFFINITY_COOKIE, token, httponly=True, samesite="lax")
+        return response
+
+    # The worker's handshake is done before the client's is accepted, so that the
+    # client gets the subprotocol the worker chose. The client's headers, like
+    # cookies and Origin, are forwarded to the worker.
+    async def proxy_websocket(self, websocket: WebSocket) -> None:
+        token = websocket.cookies.get(AFFINITY_COOKIE) or await self.new_token()
+        worker = self.worker_for(token)
+        url = f"ws://127.0.0.1:{worker.port}{websocket.url.path}"
+        if websocket.url.query:
+            url += f"?{websocket.url.query}"
+        headers = [
+            (k, v)
+            for k, v in websocket.headers.items()
+            if k not in HOP_BY_HOP_HEADERS and k not in WEBSOCKET_HANDSHAKE_HEADERS
+        ]
+        subprotocols = [Subprotocol(p) for p in websocket.scope.get("subprotocols", [])]
+
+        try:
+            upstream = await websockets.connect(
+                url,
+                max_size=None,
+                additional_headers=headers,
+                # The client's User-Agent is forwarded instead.
+                user_agent_header=None,
+                subprotocols=subprotocols or None,
+            )
+        except (OSError, websockets.WebSocketException) as e:
+            print(f"Websocket proxy could not connect to {worker.worker_id}: {e}")
+            await websocket.close(code=1011)
+            return
+
+        try:
+            async with upstream:
+                await websocket.accept(subprotocol=upstream.subprotocol)
+
+                async def client_to_worker() -> None:
+                    while True:
+                        message = await websocket.receive()
+                        if message["type"] == "websocket.disconnect":
+                            await upstream.close()
+                            return
+                        if message.get("text") is not None:
+                            await upstream.send(message["text"])
+                        elif message.get("bytes") is not None:
+                            await upstream.send(message["bytes"])
+
+                async def worker_to_client() -> None:
+                    async for message in upstream:
+                        if isinstance(message, str):
+                            await websocket.send_text(message)
+                        else:
+                            await websocket.send_bytes(message)
+                    await websocket.close()
+
+                tasks = [
+                    asyncio.create_task(client_to_worker()),
+                    asyncio.create_task(worker_to_client()),
+                ]
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in pending:
+                    task.cancel()
+                for task in done:
+                    task.result()
+        except (OSError, websockets.WebSocketException, WebSocketDisconnect) as e:
+            print(f"Websocket proxy to {worker.worker_id} closed: {e}")
+            try:
+                await websocket.close()
+            except RuntimeError:
+                pass
+
+
+async def watch_workers(workers: list[Worker]) -> None:
+    while True:
+        await asyncio.sleep(2)
+        for worker in workers:
+            if not worker.alive:
+                print(f"Worker {worker.worker_id} exited; restarting it")
+                worker.start()
+
+
+async def main(n_workers: int, host: str, port: int, base_port: int) -> None:
+    env = dict(os.environ)
+    if env.get("SHARED_STATE_DB", "") == "":
+        env["SHARED_STATE_DB"] = str(Path(tempfile.gettempdir()) / "shinyapp-state.db")
+    os.environ["SHARED_STATE_DB"] = env["SHARED_STATE_DB"]
+
+    workers = [Worker(f"worker-{i}", base_port + i, env) for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    print(
+        f"Started {n_workers} workers on ports {base_port}-{base_port + n_workers - 1}; "
+        f"shared state in {env['SHARED_STATE_DB']}"
+    )
+
+    proxy = WorkerProxy(workers)
+    watcher = asyncio.create_task(watch_workers(workers))
+    server = uvicorn.Server(uvicorn.Config(proxy.app, host=host, port=port))
+    try:
+        await server.serve()
+    finally:
+        watcher.cancel()
+        for worker in workers:
+            if worker.process is not None:
+                worker.process.terminate()
+        for worker in workers:
+            if worker.process is not None:
+                worker.process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the app in several worker processes behind a proxy."
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--base-port", type=int, default=8100)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.host, args.port, args.base_port))
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+# Rough fixed cost of an AsyncAnthropic client: the httpx connection pool, SSL
+# context, and the client object graph.
+CLIENT_OVERHEAD_BYTES = 256 * 1024
+
+# Sessions that have been active more recently than this are never evicted for
+# memory pressure, so that a user who is mid-conversation doesn't get kicked out.
+MIN_IDLE_SECS_FOR_PRESSURE_EVICTION = 60
+
+# Once session memory goes over the watermark, sessions are evicted until it's
+# under this fraction of the watermark, so that it doesn't go back over right away.
+PRESSURE_EVICTION_TARGET_FRACTION = 0.9
+
+# Most sessions evicted for memory pressure in one sweep. If the estimates are off,
+# this limits how many users are disconnected before the next sweep re-checks.
+MAX_PRESSURE_EVICTIONS_PER_SWEEP = 5
+
+
+def _env_float(name: str) -> float | None:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return None
+    return float(value)
+
+
+@dataclass
+class MemoryPolicy:
+    # Evict sessions that have been idle for longer than this. None disables it.
+    idle_timeout_secs: float | None = None
+    # Evict the most idle sessions while the memory held by sessions is above
+    # this. None disables it.
+    watermark_bytes: int | None = None
+    # How often to check sessions against the policy.
+    sweep_interval_secs: float = 30
+
+    @classmethod
+    def from_env(cls) -> MemoryPolicy:
+        idle_minutes = _env_float("SESSION_IDLE_TIMEOUT_MINUTES")
+        watermark_mb = _env_float("SESSION_MEMORY_WATERMARK_MB")
+        return cls(
+            idle_timeout_secs=None if idle_minutes is None else idle_minutes * 60,
+            watermark_bytes=(
+                None if watermark_mb is None else int(watermark_mb * 1024 * 1024)
+            ),
+        )
+
+
+@dataclass
+class SessionMemory:
+    session_id: str
+    # Called to evict the session. This should close the session; the client
+    # then saves its state to the URL hash and shows the reconnect modal.
+    evict: Callable[[], Awaitable[None]]
+    messages_bytes: int = 0
+    files_bytes: int = 0
+    # Large and binary app files that are kept to be served over HTTP.
+    asset_bytes: int = 0
+    client_bytes: int = 0
+    last_active: float = field(default_factory=time.monotonic)
+    evicting: bool = False
+
+    @property
+    def total_bytes(self) -> int:
+        return (
+            self.messages_bytes
+            + self.files_bytes
+            + self.asset_bytes
+            + self.client_bytes
+        )
+
+    def idle_secs(self, now: float | None = None) -> float:
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_active
+
+
+# Approximate the memory used by a JSON-like object. This counts the objects
+# themselves, not shared or interned values, which is good enough for comparing
+# sessions against each other.
+def estimate_bytes(obj: Any) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():  # pyright: ignore[reportUnknownVariableType]
+            size += estimate_bytes(key) + estimate_bytes(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:  # pyright: ignore[reportUnknownVariableType]
+            size += estimate_bytes(item)
+    return size
+
+
+# Resident set size of this process, or None if it can't be determined.
+def process_rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SessionMemoryTracker:
+    """
+    Keeps track of the approximate memory held by each session, and evicts
+    sessions according to a `MemoryPolicy`.
+    """
+
+    def __init__(self, policy: MemoryPolicy):
+        self.policy = policy
+        self._sessions: dict[str, SessionMemory] = {}
+        self._sweeper: asyncio.Task[None] | None = None
+
+    def register(
+        self, session_id: str, evict: Callable[[], Awaitable[None]]
+    ) -> SessionMemory:
+        record = SessionMemory(session_id=session_id, evict=evict)
+        self._sessions[session_id] = record
+        self._ensure_sweeper()
+        return record
+
+    def unregister(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def touch(self, session_id: str) -> None:
+        record = self._sessions.get(session_id)
+        if record is not None:
+            record.last_active = time.monotonic()
+
+    def update(
+        self,
+        session_id: str,
+        *,
+        messages: Any = None,
+        files: Any = None,
+        asset_bytes: int | None = None,
+        has_client: bool | None = None,
+    ) -> None:
+        record = self._sessions.get(session_id)
+        if record is None:
+            return
+        if messages is not None:
+            record.messages_bytes = estimate_bytes(messages)
+        if files is not None:
+            record.files_bytes = estimate_bytes(files)
+        if asset_bytes is not None:
+            record.asset_bytes = asset_bytes
+        if has_client is not None:
+            record.client_bytes = CLIENT_OVERHEAD_BYTES if has_client else 0
+
+    @property
+    def session_count(self) -> int:
+        return len(self._sessions)
+
+    def total_bytes(self) -> int:
+        return sum(record.total_bytes for record in self._sessions.values())
+
+    def sessions_to_evict(self, now: float | None = None) -> list[SessionMemory]:
+        """
+        Return the sessions that should be evicted under the current policy, most
+        idle first.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        candidates = sorted(
+            (r for r in self._sessions.values() if not r.evicting),
+            key=lambda r: r.last_active,
+        )
+
+        to_evict: list[SessionMemory] = []
+        idle_timeout = self.policy.idle_timeout_secs
+        if idle_timeout is not None:
+            to_evict = [r for r in candidates if r.idle_secs(now) >= idle_timeout]
+
+        # This uses the tracked session memory rather than the process's RSS,
+        # because RSS rarely goes down when sessions are freed, so it would never
+        # be projected to drop under the watermark.
+        watermark = self.policy.watermark_bytes
+        if watermark is not None and self.total_bytes() > watermark:
+            target = watermark * PRESSURE_EVICTION_TARGET_FRACTION
+            # Subtract what's already going to be freed, then keep evicting the
+            # most idle sessions until we're projected to be under the target.
+            session_bytes = self.total_bytes() - sum(r.total_bytes for r in to_evict)
+            evicted = 0
+            for record in candidates:
+                if (
+                    session_bytes <= target
+                    or evicted >= MAX_PRESSURE_EVICTIONS_PER_SWEEP
+                ):
+                    break
+                if record in to_evict:
+                    continue
+                if record.idle_secs(now) < MIN_IDLE_SECS_FOR_PRESSURE_EVICTION:
+                    continue
+                to_evict.append(record)
+                session_bytes -= record.total_bytes
+                evicted += 1
+
+        return to_evict
+
+    async def sweep(self) -> None:
+        for record in self.sessions_to_evict():
+            record.evicting = True
+            print(
+                f"Evicting session {record.session_id}: idle for "
+                f"{record.idle_secs():.0f}s, ~{record.total_bytes // 1024} KiB"
+            )
+            try:
+                await record.evict()
+            except Exception as e:
+                print(f"Error evicting session {record.session_id}: {e}")
+            self.unregister(record.session_id)
+
+    def _ensure_sweeper(self) -> None:
+        if (
+            self.policy.idle_timeout_secs is None
+            and self.policy.watermark_bytes is None
+        ):
+            return
+        if self._sweeper is not None and not self._sweeper.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._sweeper = loop.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.policy.sweep_interval_secs)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Error sweeping sessions: {e}")
+
+
+memory_tracker = SessionMemoryTracker(MemoryPolicy.from_env())
@@ -0,0 +1,391 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, TypeVar
+
+# How often each worker reports its load, and how old a report can be before the
+# worker is considered gone.
+LOAD_REPORT_INTERVAL_SECS = 5
+LOAD_REPORT_MAX_AGE_SECS = 20
+
+T = TypeVar("T")
+
+# How long an operation waits for another process's write lock before it fails
+# open.
+BUSY_TIMEOUT_SECS = 0.1
+
+# Log at most one "database is busy" message in this many seconds.
+BUSY_REPORT_INTERVAL_SECS = 10
+
+USAGE_COLUMNS = (
+    "input_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+    "output_tokens",
+)
+
+
+class SharedState:
+    """
+    Counters that are shared by all of the worker processes on a machine, stored in
+    a SQLite database in WAL mode: rate limit windows, API backoff deadlines, token
+    usage, each worker's reported load, and the state of the prompt cache warmer.
+
+    With a single worker, the database can be in memory. Each operation is one short
+    transaction on a local file, so the methods are synchronous, and can be called
+    from any thread. Async code should call them with asyncio.to_thread(), so that a
+    slow disk or another process's lock doesn't stall the event loop and every
+    session on it. If another process holds the database lock for longer than
+    BUSY_TIMEOUT_SECS, the operation fails open: rate limits and backoffs let the
+    request through, counters miss the update, and no lease is granted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.shared = path != ":memory:"
+        self._lock = threading.Lock()
+        # Setting up the database happens once, at startup, when several workers
+        # may be doing it at the same time, so it can wait longer.
+        self._conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self._busy_count = 0
+        self._busy_reported_at = 0.0
+        if self.shared:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS rate_windows (
+                key TEXT NOT NULL,
+                window_start INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (key, window_start)
+            );
+            CREATE TABLE IF NOT EXISTS backoffs (
+                key TEXT PRIMARY KEY,
+                until REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                {", ".join(f"{col} INTEGER NOT NULL DEFAULT 0" for col in USAGE_COLUMNS)},
+                PRIMARY KEY (day, model)
+            );
+            CREATE TABLE IF NOT EXISTS worker_loads (
+                worker_id TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                sessions INTEGER NOT NULL,
+                active_streams INTEGER NOT NULL,
+                session_bytes INTEGER NOT NULL,
+                rss_bytes INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS prompt_cache_uses (
+                prompt TEXT PRIMARY KEY,
+                last_used REAL NOT NULL,
+                by_warmer INTEGER NOT NULL
+            );
+            """)
+        self._conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT_SECS * 1000)}")
+
+    @classmethod
+    def from_env(cls) -> SharedState:
+        path = os.environ.get("SHARED_STATE_DB")
+        if path is None or path == "":
+            path = ":memory:"
+        return cls(path)
+
+    def _transaction(self, fn: Callable[[sqlite3.Connection], T], fallback: T) -> T:
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so that a read followed by a
+            # write can't race with another process.
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                self._report_busy(e)
+                return fallback
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+            except sqlite3.OperationalError as e:
+                self._rollback()
+                self._report_busy(e)
+                return fallback
+            except BaseException:
+                self._rollback()
+                raise
+            return result
+
+    def _rollback(self) -> None:
+        # SQLite may have already rolled back the transaction after an error.
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+
+    def _read(self, fn: Callable[[sqlite3.Connection], T], fallback: T) -> T:
+        with self._lock:
+            try:
+                return fn(self._conn)
+            except sqlite3.OperationalError as e:
+                self._report_busy(e)
+                return fallback
+
+    def _report_busy(self, e: sqlite3.OperationalError) -> None:
+        self._busy_count += 1
+        now = time.monotonic()
+        if now - self._busy_reported_at >= BUSY_REPORT_INTERVAL_SECS:
+            self._busy_reported_at = now
+            print(
+                f"Shared state database unavailable ({e}); failed open "
+                f"{self._busy_count} time(s) so far"
+            )
+
+    # Count an event against a fixed-window rate limit. Returns False, without
+    # counting it, if the limit for the current window has been reached.
+    def try_acquire(self, key: str, limit: int, window_secs: int = 60) -> bool:
+        window_start = int(time.time()) // window_secs * window_secs
+
+        def acquire(conn: sqlite3.Connection) -> bool:
+            row = conn.execute(
+                "SELECT count FROM rate_windows WHERE key = ? AND window_start = ?",
+                (key, window_start),
+            ).fetchone()
+            if row is not None and row[0] >= limit:
+                return False
+            conn.execute(
+                "INSERT INTO rate_windows (key, window_start, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (key, window_start) DO UPDATE SET count = count + 1",
+                (key, window_start),
+            )
+            conn.execute(
+                "DELETE FROM rate_windows WHERE key = ? AND window_start < ?",
+                (key, window_start),
+            )
+            return True
+
+        return self._transaction(acquire, fallback=True)
+
+    # Count an event for event_count(). This shares the rate_windows table with
+    # try_acquire(), but keeps the previous window too.
+    def record_event(self, key: str, window_secs: int = 3600) -> None:
+        window_start = int(time.time()) // window_secs * window_secs
+
+        def record(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                "INSERT INTO rate_windows (key, window_start, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (key, window_start) DO UPDATE SET count = count + 1",
+                (key, window_start),
+            )
+            conn.execute(
+                "DELETE FROM rate_windows WHERE key = ? AND window_start < ?",
+                (key, window_start - window_secs),
+            )
+
+        self._transaction(record, fallback=None)
+
+    # Approximate number of events in the last `window_secs` seconds: the count in
+    # the current window, plus the previous window's count weighted by how much of
+    # it is still within the last `window_secs`.
+    def event_count(self, key: str, window_secs: int = 3600) -> float:
+        now = time.time()
+        window_start = int(now) // window_secs * window_secs
+        rows: list[tuple[int, int]] = self._read(
+            lambda conn: conn.execute(
+                "SELECT window_start, count FROM rate_windows "
+                "WHERE key = ? AND window_start >= ?",
+                (key, window_start - window_secs),
+            ).fetchall(),
+            fallback=[],
+        )
+        counts = dict(rows)
+        overlap = 1 - (now - window_start) / window_secs
+        return (
+            counts.get(window_start, 0)
+            + counts.get(window_start - window_secs, 0) * overlap
+        )
+
+    # Take or renew a lease that only one owner can hold at a time, e.g. so that a
+    # background job runs in only one worker. Returns whether `owner` holds it. If
+    # the owner stops renewing it, another can take it after `ttl_secs`.
+    def try_acquire_lease(self, name: str, owner: str, ttl_secs: float) -> bool:
+        now = time.time()
+
+        def acquire(conn: sqlite3.Connection) -> bool:
+            row = conn.execute(
+                "SELECT owner, expires_at FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, "
+                "expires_at = excluded.expires_at",
+                (name, owner, now + ttl_secs),
+            )
+            return True
+
+        return self._transaction(acquire, fallback=False)
+
+    # Record that a system prompt was sent with a cache breakpoint, at `used_at`
+    # (from time.time()). Returns when it was last used before that, and whether
+    # that use was a warmup request, or None if it hasn't been used.
+    def record_prompt_use(
+        self, prompt: str, used_at: float, by_warmer: bool
+    ) -> tuple[float, bool] | None:
+        def record(conn: sqlite3.Connection) -> tuple[float, bool] | None:
+            row = conn.execute(
+                "SELECT last_used, by_warmer FROM prompt_cache_uses WHERE prompt = ?",
+                (prompt,),
+            ).fetchone()
+            conn.execute(
+                "INSERT INTO prompt_cache_uses (prompt, last_used, by_warmer) "
+                "VALUES (?, ?, ?) ON CONFLICT (prompt) DO UPDATE SET "
+                "last_used = excluded.last_used, by_warmer = excluded.by_warmer "
+                "WHERE excluded.last_used >= last_used",
+                (prompt, used_at, int(by_warmer)),
+            )
+            return None if row is None else (row[0], bool(row[1]))
+
+        return self._transaction(record, fallback=None)
+
+    def prompt_last_used(self, prompt: str) -> float | None:
+        row = self._read(
+            lambda conn: conn.execute(
+                "SELECT last_used FROM prompt_cache_uses WHERE prompt = ?", (prompt,)
+            ).fetchone(),
+            fallback=None,
+        )
+        return None if row is None else row[0]
+
+    # Make every worker back off from `key` for the next `secs` seconds, e.g. after
+    # a rate limit error from the API.
+    def set_backoff(self, key: str, secs: float) -> None:
+        until = time.time() + secs
+        self._transaction(
+            lambda conn: conn.execute(
+                "INSERT INTO backoffs (key, until) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET until = MAX(until, excluded.until)",
+                (key, until),
+            ),
+            fallback=None,
+        )
+
+    def backoff_remaining(self, key: str) -> float:
+        row = self._read(
+            lambda conn: conn.execute(
+                "SELECT until FROM backoffs WHERE key = ?", (key,)
+            ).fetchone(),
+            fallback=None,
+        )
+        if row is None:
+            return 0.0
+        return max(0.0, row[0] - time.time())
+
+    def record_usage(self, model: str, usage: dict[str, int]) -> None:
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        values = [usage.get(col, 0) for col in USAGE_COLUMNS]
+        self._transaction(
+            lambda conn: conn.execute(
+                f"INSERT INTO usage (day, model, requests, {', '.join(USAGE_COLUMNS)}) "
+                f"VALUES (?, ?, 1, {', '.join('?' * len(USAGE_COLUMNS))}) "
+                "ON CONFLICT (day, model) DO UPDATE SET requests = requests + 1, "
+                + ", ".join(f"{col} = {col} + excluded.{col}" for col in USAGE_COLUMNS),
+                (day, model, *values),
+            ),
+            fallback=None,
+        )
+
+    def usage(self, day: str | None = None) -> list[dict[str, Any]]:
+        if day is None:
+            day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+        def read(conn: sqlite3.Connection) -> list[dict[str, Any]]:
+            cursor = conn.execute("SELECT * FROM usage WHERE day = ?", (day,))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+        return self._read(read, fallback=[])
+
+    def report_load(self, worker_id: str, load: dict[str, int | None]) -> None:
+        self._transaction(
+            lambda conn: conn.execute(
+                "INSERT OR REPLACE INTO worker_loads (worker_id, pid, updated_at, "
+                "sessions, active_streams, session_bytes, rss_bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    worker_id,
+                    os.getpid(),
+                    time.time(),
+                    load["sessions"],
+                    load["active_streams"],
+                    load["session_bytes"],
+                    load["rss_bytes"],
+                ),
+            ),
+            fallback=None,
+        )
+
+    # The latest load reported by each worker that has reported recently.
+    def worker_loads(
+        self, max_age_secs: float = LOAD_REPORT_MAX_AGE_SECS
+    ) -> dict[str, dict[str, Any]]:
+
+        def read(conn: sqlite3.Connection) -> list[dict[str, Any]]:
+            cursor = conn.execute(
+                "SELECT * FROM worker_loads WHERE updated_at >= ?",
+                (time.time() - max_age_secs,),
+            )
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+        return {row["worker_id"]: row for row in self._read(read, fallback=[])}
+
+
+class LoadReporter:
+    """
+    Periodically writes this worker's load to the shared state, so that the proxy in
+    scripts/serve_workers.py can see it.
+    """
+
+    def __init__(
+        self,
+        state: SharedState,
+        worker_id: str,
+        get_load: Callable[[], dict[str, int | None]],
+    ):
+        self.state = state
+        self.worker_id = worker_id
+        self.get_load = get_load
+        self._task: asyncio.Task[None] | None = None
+
+    # Start reporting, if it hasn't been started yet. Reporting only makes sense if
+    # the state is shared with other processes.
+    def start(self) -> None:
+        if not self.state.shared:
+            return
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                load = self.get_load()
+                await asyncio.to_thread(self.state.report_load, self.worker_id, load)
+            except Exception as e:
+                print(f"Error reporting worker load: {e}")
+            await asyncio.sleep(LOAD_REPORT_INTERVAL_SECS)
+
+
+shared_state = SharedState.from_env()
+worker_id = os.environ.get("WORKER_ID", f"pid-{os.getpid()}")
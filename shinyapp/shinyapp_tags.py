@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Callable, Literal
+
+from local_types import FileContent
+from shiny import reactive
+
+SHINYAPP_AUTORUN_OPEN_TAG = '<SHINYAPP AUTORUN="1">'
+SHINYAPP_CLOSE_TAG = "</SHINYAPP>"
+
+ShinyappStreamEvent = Literal["opened", "closed"]
+
+
+class ShinyappStreamTracker:
+    """
+    Watches a streaming response for the first `<SHINYAPP AUTORUN="1">` tag and the
+    `</SHINYAPP>` tag that closes it.
+
+    Only the end of the content that could contain a tag that was completed by the
+    latest chunk is searched, so the work per chunk doesn't grow with the length of
+    the response.
+    """
+
+    def __init__(self):
+        self.autorun_start: int | None = None
+        self.closed = False
+
+    def feed(self, content: str, chunk: str) -> list[ShinyappStreamEvent]:
+        events: list[ShinyappStreamEvent] = []
+        if self.closed:
+            return events
+
+        if self.autorun_start is None:
+            start = max(0, len(content) - len(chunk) - len(SHINYAPP_AUTORUN_OPEN_TAG))
+            pos = content.find(SHINYAPP_AUTORUN_OPEN_TAG, start)
+            if pos == -1:
+                return events
+            self.autorun_start = pos
+            events.append("opened")
+
+        start = max(
+            self.autorun_start + len(SHINYAPP_AUTORUN_OPEN_TAG),
+            len(content) - len(chunk) - len(SHINYAPP_CLOSE_TAG),
+        )
+        if content.find(SHINYAPP_CLOSE_TAG, start) != -1:
+            self.closed = True
+            events.append("closed")
+
+        return events
+
+
+# The work that the chat's response transform does for each chunk: watch for the
+# <SHINYAPP> tags with `tracker`, and convert the content to its display form. The
+# reactive lock is shared by all sessions in the process, so it's only taken when
+# a tag is opened or closed. Then `on_tags` is called with the events and the
+# content, while holding the lock, and a reactive flush is run.
+async def transform_response_chunk(
+    tracker: ShinyappStreamTracker,
+    content: str,
+    chunk: str,
+    on_tags: Callable[[list[ShinyappStreamEvent], str], None],
+) -> str:
+    # Only do this when streaming. (We don't to run it when restoring messages,
+    # which does not use streaming.)
+    if chunk != "":
+        events = tracker.feed(content, chunk)
+        if len(events) > 0:
+            async with reactive.lock():
+                with reactive.isolate():
+                    on_tags(events, content)
+                    await reactive.flush()
+
+    # Complete messages, including all restored messages, use a display form
+    # that is cached by content, so restoring a long session is a cache lookup
+    # per message instead of a set of regex passes.
+    if chunk == "":
+        return cached_shinyapp_tags_to_html(content)
+
+    # TODO: This is inefficient because it does this processing for every chunk,
+    # which means it will process the same content multiple times. It would be
+    # better to do this incrementally as the content streams in.
+    return shinyapp_tags_to_html(content)
+
+
+# Convert the <SHINYAPP> and <FILE> tags in an assistant message to the HTML that is
+# displayed in the chat.
+def shinyapp_tags_to_html(content: str) -> str:
+    # Most messages, and the start of most streaming responses, have no tags.
+    if "SHINYAPP" not in content and "FILE" not in content:
+        return content
+
+    content = re.sub(
+        '<SHINYAPP AUTORUN="[01]">', "<div class='assistant-shinyapp'>\n", content
+    )
+    content = content.replace(
+        "</SHINYAPP>",
+        "\n<div class='run-code-button-container'>"
+        "<button class='run-code-button btn btn-outline-primary'>Run app →</button>"
+        "</div>\n</div>",
+    )
+    content = re.sub(
+        '\n<FILE NAME="(.*?)"(?: TYPE="(text|binary)")?>',
+        r"\n<div class='assistant-shinyapp-file' data-type='\2'>\n<div class='filename'>\1</div>\n\n```",
+        content,
+    )
+    content = content.replace("\n</FILE>", "\n```\n</div>")
+
+    return content
+
+
+# Display forms of complete messages, keyed by a hash of the message content. This
+# is shared by all sessions, so when a session is restored, messages that were
+# already displayed (in this session before it disconnected, or any other) don't
+# need to be converted again.
+_html_cache: OrderedDict[bytes, str] = OrderedDict()
+_html_cache_bytes = 0
+MAX_HTML_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def cached_shinyapp_tags_to_html(content: str) -> str:
+    """
+    Like `shinyapp_tags_to_html()`, but cached. Only use this for complete messages;
+    caching each partial message in a stream would just fill the cache.
+    """
+    global _html_cache_bytes
+
+    key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+    html = _html_cache.get(key)
+    if html is not None:
+        _html_cache.move_to_end(key)
+        return html
+
+    html = shinyapp_tags_to_html(content)
+    _html_cache[key] = html
+    _html_cache_bytes += len(html)
+    while _html_cache_bytes > MAX_HTML_CACHE_BYTES and len(_html_cache) > 1:
+        _, evicted = _html_cache.popitem(last=False)
+        _html_cache_bytes -= len(evicted)
+    return html
+
+
+def shinyapp_tag_contents_to_filecontents(input: str) -> list[FileContent]:
+    """
+    Extracts the files and their contents from the <SHINYAPP>...</SHINYAPP> tags in the
+    input string.
+    """
+    # Keep the text between the SHINYAPP tags
+    shinyapp_code = re.sub(
+        r".*<SHINYAPP AUTORUN=\"[01]\">(.*)</SHINYAPP>.*",
+        r"\1",
+        input,
+        flags=re.DOTALL,
+    )
+    if shinyapp_code.startswith("\n"):
+        shinyapp_code = shinyapp_code[1:]
+
+    # Find each <FILE NAME="...">...</FILE> tag and extract the contents and file name.
+    # Binary files have a TYPE="binary" attribute, and base64-encoded contents.
+    file_contents: list[FileContent] = []
+    for match in re.finditer(
+        r"<FILE NAME=\"(.*?)\"(?: TYPE=\"(text|binary)\")?>(.*?)</FILE>",
+        input,
+        re.DOTALL,
+    ):
+        name = match.group(1)
+        content = match.group(3)
+        if match.group(2) == "binary":
+            content = "".join(content.split())
+            file_contents.append({"name": name, "content": content, "type": "binary"})
+            continue
+        if content.startswith("\n"):
+            content = content[1:]
+        file_contents.append({"name": name, "content": content, "type": "text"})
+
+    return file_contents
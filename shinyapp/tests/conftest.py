@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# The app's modules are imported from the app directory, as in scripts/.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
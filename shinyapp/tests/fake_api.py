@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import socket
+from typing import Any, AsyncIterator, Awaitable, Callable, Sequence, TypeVar
+
+import uvicorn
+from anthropic import AsyncAnthropic
+from llm_stream import TurnContext
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route as StarletteRoute
+
+T = TypeVar("T")
+
+# A response for the fake endpoint to stream: its text, or its text and stop reason.
+FakeResponse = str | tuple[str, str]
+
+
+class FakeMessagesEndpoint:
+    """
+    A stand-in for the Messages API that records the requests, and sends back the
+    registered responses in order, streamed if the request asks for it. `usage` is
+    added to the usage reported for each response, e.g. to report cache writes.
+    """
+
+    def __init__(
+        self, responses: Sequence[FakeResponse], usage: dict[str, int] | None = None
+    ):
+        self.responses = list(responses)
+        self.usage = usage or {}
+        self.requests: list[dict[str, Any]] = []
+        self.app = Starlette(
+            routes=[StarletteRoute("/v1/messages", self.handle, methods=["POST"])]
+        )
+
+    async def handle(self, request: Request) -> JSONResponse | StreamingResponse:
+        body = await request.json()
+        self.requests.append(body)
+        response = self.responses[len(self.requests) - 1]
+        text, stop_reason = (
+            (response, "end_turn") if isinstance(response, str) else response
+        )
+        message: dict[str, Any] = {
+            "id": "msg_test",
+            "type": "message",
+            "role": "assistant",
+            "model": body["model"],
+            "content": [],
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 1, **self.usage},
+        }
+        if not body.get("stream"):
+            return JSONResponse(
+                {
+                    **message,
+                    "content": [{"type": "text", "text": text}],
+                    "stop_reason": stop_reason,
+                }
+            )
+
+        def event(data: dict[str, Any]) -> str:
+            return f"event: {data['type']}\ndata: {json.dumps(data)}\n\n"
+
+        async def events() -> AsyncIterator[str]:
+            yield event({"type": "message_start", "message": message})
+            yield event(
+                {
+                    "type": "content_block_start",
+                    "index": 0,
+                    "content_block": {"type": "text", "text": ""},
+                }
+            )
+            yield event(
+                {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": text},
+                }
+            )
+            yield event({"type": "content_block_stop", "index": 0})
+            yield event(
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                    "usage": {"output_tokens": len(text) // 4},
+                }
+            )
+            yield event({"type": "message_stop"})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Serve the endpoint in this process while `fn` runs, and pass it the base URL.
+async def with_endpoint(
+    endpoint: FakeMessagesEndpoint, fn: Callable[[str], Awaitable[T]]
+) -> T:
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(endpoint.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        return await fn(f"http://127.0.0.1:{port}")
+    finally:
+        server.should_exit = True
+        await serve_task
+
+
+def make_turn(base_url: str, uses_server_api_key: bool = True) -> TurnContext:
+    return TurnContext(
+        client=AsyncAnthropic(api_key="test", base_url=base_url),
+        system_prompt="You are Shiny Assistant.",
+        language="python",
+        verbosity="Concise",
+        uses_server_api_key=uses_server_api_key,
+    )
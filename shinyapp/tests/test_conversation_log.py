@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import gzip
+import json
+from pathlib import Path
+
+from conversation_log import (
+    MAX_LOGGED_TEXT_CHARS,
+    ConversationLogger,
+    message_for_log,
+)
+
+
+def test_dropped_records_are_logged(tmp_path: Path):
+    logger = ConversationLogger(tmp_path, flush_interval_secs=0.05)
+    # As if three records didn't fit in the queue.
+    logger.dropped = 3
+    logger.log({"response": "hello"})
+    logger.close()
+
+    records = [
+        json.loads(line)
+        for path in tmp_path.glob("*.jsonl.gz")
+        for line in gzip.open(path, "rt")
+    ]
+    assert {"response": "hello"} in records
+    assert sum(r.get("dropped_records", 0) for r in records) == 3
+
+
+def test_message_for_log_cuts_long_text():
+    editor_files = json.dumps([{"name": "app.py", "content": "x" * 100000}])
+    logged = message_for_log(
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Add a title"},
+                {"type": "text", "text": f"<CONTEXT>{editor_files}</CONTEXT>"},
+            ],
+        }
+    )
+    assert logged["content"][0] == {"type": "text", "text": "Add a title"}
+    text = logged["content"][1]["text"]
+    assert len(text) < MAX_LOGGED_TEXT_CHARS + 100
+    assert text.endswith("chars omitted]")
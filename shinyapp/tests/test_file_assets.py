@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from typing import Callable
+
+import file_assets
+import pytest
+from file_assets import SessionAssetStore
+from local_types import FileContent
+from starlette.requests import Request
+from starlette.responses import Response
+
+KB = 1024
+
+
+class AssetRoute:
+    """Stands in for the session's dynamic route, and requests assets from it."""
+
+    def __init__(self):
+        self.handler: Callable[[Request], Response] | None = None
+
+    def register(self, name: str, handler: Callable[[Request], Response]) -> str:
+        self.handler = handler
+        return f"session/{name}?nonce=1"
+
+    def status(self, sha256: str) -> int:
+        assert self.handler is not None
+        request = Request(
+            {
+                "type": "http",
+                "method": "GET",
+                "query_string": f"sha256={sha256}".encode(),
+                "headers": [],
+            }
+        )
+        return self.handler(request).status_code
+
+
+def large_file(name: str, char: str) -> FileContent:
+    return {"name": name, "type": "text", "content": char * (100 * KB)}
+
+
+def test_least_recently_stored_assets_are_evicted(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(file_assets, "MAX_SESSION_ASSET_BYTES", 250 * KB)
+    route = AssetRoute()
+    store = SessionAssetStore(route.register)
+    first, second, third = [store.externalize(large_file(f"{c}.txt", c)) for c in "abc"]
+    assert store.total_bytes == 200 * KB
+    assert "sha256" in first and "sha256" in second and "sha256" in third
+    assert route.status(first["sha256"]) == 404
+    assert route.status(second["sha256"]) == 200
+    assert route.status(third["sha256"]) == 200
+
+
+def test_files_sent_together_are_not_evicted(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(file_assets, "MAX_SESSION_ASSET_BYTES", 250 * KB)
+    store = SessionAssetStore(AssetRoute().register)
+    store.externalize(large_file("old.txt", "o"))
+    # The client will fetch all of these, so they're kept even though they're over
+    # the limit together.
+    store.externalize_all([large_file(f"{c}.txt", c) for c in "abc"])
+    assert store.total_bytes == 300 * KB
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+
+from anthropic.types import MessageParam
+from fake_api import FakeMessagesEndpoint, make_turn, with_endpoint
+from llm_stream import (
+    CONTINUE_PROMPT,
+    CancellableStream,
+    create_response_stream,
+    stream_with_continuations,
+)
+from routing import DEFAULT_MODEL, MAX_CONTINUATIONS, Route
+
+ROUTE = Route(kind="app", model=DEFAULT_MODEL, max_tokens=12000)
+USER_MESSAGE: MessageParam = {"role": "user", "content": "Make an app"}
+
+FIRST_PART = 'Here is the app.\n\n<SHINYAPP AUTORUN="1">\n<FILE NAME="app.py">\n'
+SECOND_PART = "from shiny import App, ui\n"
+LAST_PART = "app = App(ui.page_fluid(), None)\n</FILE>\n</SHINYAPP>\n"
+
+
+async def stream_all(
+    endpoint: FakeMessagesEndpoint, can_continue: bool = True
+) -> tuple[str, int]:
+    async def run(base_url: str) -> tuple[str, int]:
+        turn = make_turn(base_url)
+        stream = await create_response_stream(turn, (USER_MESSAGE,), ROUTE)
+        streams: list[CancellableStream] = []
+        text = ""
+
+        async def allow_continuation() -> bool:
+            return can_continue
+
+        async for chunk in stream_with_continuations(
+            turn,
+            stream,
+            (USER_MESSAGE,),
+            ROUTE,
+            can_continue=allow_continuation,
+            on_stream=streams.append,
+        ):
+            if isinstance(chunk, str):
+                text += chunk
+            elif chunk.type == "content_block_delta":
+                text += chunk.delta.text
+        return text, len(streams)
+
+    return await with_endpoint(endpoint, run)
+
+
+def test_continues_response_cut_off_inside_app():
+    endpoint = FakeMessagesEndpoint(
+        [
+            (FIRST_PART, "max_tokens"),
+            (SECOND_PART, "max_tokens"),
+            LAST_PART,
+        ]
+    )
+    text, n_streams = asyncio.run(stream_all(endpoint))
+
+    assert text == FIRST_PART + SECOND_PART + LAST_PART
+    assert n_streams == 2
+    assert len(endpoint.requests) == 3
+
+    # The partial response is sent as a complete assistant turn, followed by a user
+    # turn asking for the rest, rather than as a prefill.
+    last_request = endpoint.requests[-1]["messages"]
+    assert [m["role"] for m in last_request] == ["user", "assistant", "user"]
+    assert last_request[1]["content"] == FIRST_PART + SECOND_PART
+    assert last_request[2]["content"] == CONTINUE_PROMPT
+
+
+def test_continuations_are_limited():
+    endpoint = FakeMessagesEndpoint(
+        [(FIRST_PART, "max_tokens")] + [(SECOND_PART, "max_tokens")] * 5
+    )
+    text, n_streams = asyncio.run(stream_all(endpoint))
+
+    assert n_streams == MAX_CONTINUATIONS
+    assert text == FIRST_PART + SECOND_PART * MAX_CONTINUATIONS
+
+
+def test_no_continuation_outside_app_or_without_capacity():
+    endpoint = FakeMessagesEndpoint([("A long explanation", "max_tokens")])
+    text, n_streams = asyncio.run(stream_all(endpoint))
+    assert (text, n_streams) == ("A long explanation", 0)
+
+    endpoint = FakeMessagesEndpoint([(FIRST_PART, "max_tokens")])
+    text, n_streams = asyncio.run(stream_all(endpoint, can_continue=False))
+    assert text.startswith(FIRST_PART) and "rate limit" in text
+    assert n_streams == 0
+    assert len(endpoint.requests) == 1
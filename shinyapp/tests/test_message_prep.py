@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+from anthropic.types import MessageParam
+from message_prep import prepare_messages, trim_messages
+
+
+def message(role: str, tokens: int) -> MessageParam:
+    return {"role": role, "content": "x" * (tokens * 4)}  # pyright: ignore
+
+
+def test_trim_messages_keeps_newest_messages_that_fit():
+    messages = (
+        message("user", 300),
+        message("assistant", 300),
+        message("user", 100),
+        message("assistant", 100),
+        message("user", 100),
+    )
+    assert trim_messages(messages, (1000, 500)) == messages[2:]
+    assert trim_messages(messages, (2000, 500)) == messages
+    # The history must start with a user message.
+    assert trim_messages(messages, (750, 500)) == messages[4:]
+    # The last message is kept even if it doesn't fit.
+    assert trim_messages(messages, (600, 550)) == messages[4:]
+
+
+def test_prepare_messages():
+    messages = (
+        message("user", 10),
+        message("assistant", 10),
+        message("assistant", 20),
+        message("user", 10),
+    )
+    prepared, prompt = prepare_messages(messages, "[]")
+    assert [m["role"] for m in prepared] == ["user", "assistant", "user"]
+    assert prepared[1]["content"] == [{"type": "text", "text": "x" * 80}]
+    assert prompt == "x" * 40
+    assert "<CONTEXT>" in prepared[-1]["content"][-1]["text"]  # pyright: ignore
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import prompt_cache
+import pytest
+from anthropic import AsyncAnthropic
+from fake_api import FakeMessagesEndpoint, with_endpoint
+from prompt_cache import CACHE_TTL_SECS, PromptCacheWarmer
+from prompts import build_app_prompt
+from shared_state import SharedState
+
+# There is one system prompt for each language and verbosity.
+N_PROMPTS = 6
+
+
+def make_endpoint(cache_creation_input_tokens: int = 2000) -> FakeMessagesEndpoint:
+    return FakeMessagesEndpoint(
+        ["."] * 20,
+        usage={"cache_creation_input_tokens": cache_creation_input_tokens},
+    )
+
+
+def make_warmer(state: SharedState, owner: str, base_url: str) -> PromptCacheWarmer:
+    client = AsyncAnthropic(api_key="test", base_url=base_url)
+    return PromptCacheWarmer(0, state, owner, client=client)
+
+
+def run_with_endpoint(
+    endpoint: FakeMessagesEndpoint, fn: Callable[[str], Awaitable[None]]
+) -> None:
+    asyncio.run(with_endpoint(endpoint, fn))
+
+
+def test_only_one_worker_warms(tmp_path: Path):
+    path = str(tmp_path / "state.db")
+    endpoint = make_endpoint()
+
+    async def run(base_url: str):
+        warmer1 = make_warmer(SharedState(path), "worker-1", base_url)
+        warmer2 = make_warmer(SharedState(path), "worker-2", base_url)
+        assert await warmer1.refresh()
+        assert not await warmer2.refresh()
+
+    run_with_endpoint(endpoint, run)
+    assert len(endpoint.requests) == N_PROMPTS
+
+
+def test_uncacheable_prompts_are_not_refreshed(tmp_path: Path):
+    state = SharedState(str(tmp_path / "state.db"))
+    endpoint = make_endpoint(cache_creation_input_tokens=0)
+
+    async def run(base_url: str):
+        warmer = make_warmer(state, "worker-1", base_url)
+        await warmer.refresh()
+        assert len(endpoint.requests) == N_PROMPTS
+
+        # Even if the prompts are in use and about to expire, they aren't warmed
+        # again.
+        for key in ("r/Concise", "python/Concise"):
+            state.record_prompt_use(key, time.time() - CACHE_TTL_SECS + 10, False)
+        assert not await warmer.refresh()
+
+    run_with_endpoint(endpoint, run)
+    assert len(endpoint.requests) == N_PROMPTS
+
+
+class FakeClock:
+    """Stands in for the time module in prompt_cache.py."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def test_prompts_about_to_expire_are_refreshed(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    clock = FakeClock()
+    monkeypatch.setattr(prompt_cache, "time", clock)
+    state = SharedState(str(tmp_path / "state.db"))
+    endpoint = make_endpoint()
+
+    async def run(base_url: str):
+        warmer = make_warmer(state, "worker-1", base_url)
+        # The first refresh warms all of the prompts.
+        assert await warmer.refresh()
+        warmed_at = clock.now
+
+        # One of them is used by a user's request on another worker a minute later.
+        # When the others have expired, it's about to, so only it is refreshed.
+        state.record_prompt_use("python/Concise", warmed_at + 60, False)
+        clock.now = warmed_at + CACHE_TTL_SECS + 30
+        assert await warmer.refresh()
+
+    run_with_endpoint(endpoint, run)
+    assert [r["system"][0]["text"] for r in endpoint.requests[N_PROMPTS:]] == [
+        build_app_prompt("python", "Concise")
+    ]
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, AsyncIterable
+
+from anthropic.types import MessageParam
+from chat_responses import REPAIR_PREAMBLE, ChatResponder
+from fake_api import FakeMessagesEndpoint, FakeResponse, make_turn, with_endpoint
+from local_types import FileContent
+from message_prep import message_text, prepare_messages
+from routing import DEFAULT_MODEL, Route
+from shared_state import SharedState
+from shinyapp_tags import shinyapp_tag_contents_to_filecontents
+
+BROKEN_APP = """Here's the app.
+
+<SHINYAPP AUTORUN="1">
+<FILE NAME="app.py">
+import notapackage
+from shiny import App, ui
+
+app = App(ui.page_fluid(), None)
+</FILE>
+</SHINYAPP>
+"""
+
+REPAIRED_APP = """I removed the import of `notapackage`.
+
+<SHINYAPP AUTORUN="1">
+<FILE NAME="app.py">
+from shiny import App, ui
+
+app = App(ui.page_fluid(), None)
+</FILE>
+</SHINYAPP>
+"""
+
+ROUTE = Route(kind="app", model=DEFAULT_MODEL, max_tokens=12000)
+USER_MESSAGE: MessageParam = {"role": "user", "content": "Make an app"}
+
+
+class FakeChat:
+    """
+    Stands in for the chat and the server function around a ChatResponder. As in the
+    app, response streams are consumed in the background, the app in a response is
+    checked once its </SHINYAPP> tag has arrived, and the responder is told when
+    each message is complete.
+    """
+
+    def __init__(self, base_url: str, rate_limit_per_minute: int = 0):
+        self.messages: list[MessageParam] = [USER_MESSAGE]
+        self.sent_files: list[list[FileContent]] = []
+        self.tasks: list[asyncio.Task[None]] = []
+        self.turn = make_turn(base_url)
+        self.responder = ChatResponder(
+            self,
+            "session",
+            read_messages=self.read_messages,
+            send_files=self.send_files,
+            show_error=self.show_error,
+            on_response_start=lambda: None,
+            state=SharedState(":memory:"),
+            rate_limit_per_minute=rate_limit_per_minute,
+        )
+
+    async def append_message(self, message: Any) -> None:
+        self.messages.append(message)
+        self.responder.message_done()
+
+    async def append_message_stream(self, message: AsyncIterable[Any]) -> None:
+        self.tasks.append(asyncio.create_task(self._consume(message)))
+
+    async def _consume(self, stream: AsyncIterable[Any]) -> None:
+        content = ""
+        async for chunk in stream:
+            if isinstance(chunk, str):
+                content += chunk
+            elif chunk.type == "content_block_delta":
+                content += chunk.delta.text
+        if "</SHINYAPP>" in content:
+            files = shinyapp_tag_contents_to_filecontents(content)
+            self.responder.check_app(files, "python")
+        self.messages.append({"role": "assistant", "content": content})
+        self.responder.message_done()
+
+    async def read_messages(self) -> tuple[MessageParam, ...]:
+        return tuple(self.messages)
+
+    async def send_files(self, files: list[FileContent]) -> None:
+        self.sent_files.append(files)
+
+    async def show_error(self, e: Exception) -> None:
+        raise e
+
+    # Wait for the responses, checks, and repairs that are in progress to finish.
+    async def settle(self) -> None:
+        while True:
+            pending = [
+                task
+                for task in [
+                    *self.tasks,
+                    self.responder.validation,
+                    self.responder.repair_task,
+                ]
+                if task is not None and not task.done()
+            ]
+            if len(pending) == 0:
+                return
+            await asyncio.wait(pending)
+
+    def contents(self) -> list[str]:
+        return [str(message["content"]) for message in self.messages]
+
+
+def run_with_chat(
+    responses: list[FakeResponse], fn: Any, rate_limit_per_minute: int = 0
+) -> FakeMessagesEndpoint:
+    endpoint = FakeMessagesEndpoint(responses)
+
+    async def run(base_url: str) -> None:
+        await fn(FakeChat(base_url, rate_limit_per_minute))
+
+    asyncio.run(with_endpoint(endpoint, run))
+    return endpoint
+
+
+def test_broken_app_is_repaired_before_it_is_sent():
+    async def run(chat: FakeChat):
+        assert await chat.responder.stream_response(chat.turn, (USER_MESSAGE,), ROUTE)
+        await chat.settle()
+
+        assert chat.contents() == [
+            "Make an app",
+            BROKEN_APP,
+            REPAIR_PREAMBLE + REPAIRED_APP,
+        ]
+        # Only the repaired app is sent to the shinylive panel.
+        assert chat.sent_files == [shinyapp_tag_contents_to_filecontents(REPAIRED_APP)]
+
+        # The repair response follows the broken one, but only the repaired one is
+        # sent to the model on the next turn.
+        next_message: MessageParam = {"role": "user", "content": "Add a title"}
+        messages, _ = prepare_messages((*chat.messages, next_message), "[]")
+        assert [m["role"] for m in messages] == ["user", "assistant", "user"]
+        assert REPAIRED_APP in message_text(messages[1])
+
+    endpoint = run_with_chat([BROKEN_APP, REPAIRED_APP], run)
+
+    assert len(endpoint.requests) == 2
+    repair_request = endpoint.requests[1]
+    assert repair_request["system"][0]["text"] == "You are Shiny Assistant."
+    assert [m["role"] for m in repair_request["messages"]] == [
+        "user",
+        "assistant",
+        "user",
+    ]
+    repair_text = repair_request["messages"][-1]["content"][0]["text"]
+    assert "An automated check found these problems" in repair_text
+    assert "notapackage" in repair_text
+
+
+def test_repaired_app_is_sent_even_if_it_still_has_problems():
+    async def run(chat: FakeChat):
+        await chat.responder.stream_response(chat.turn, (USER_MESSAGE,), ROUTE)
+        await chat.settle()
+        assert chat.sent_files == [shinyapp_tag_contents_to_filecontents(BROKEN_APP)]
+        assert len(chat.messages) == 3
+
+    endpoint = run_with_chat([BROKEN_APP, BROKEN_APP], run)
+    assert len(endpoint.requests) == 2
+
+
+def test_error_message_does_not_repair_previous_turns_app():
+    async def run(chat: FakeChat):
+        await chat.responder.stream_response(chat.turn, (USER_MESSAGE,), ROUTE)
+        await chat.settle()
+        # The rate limit doesn't allow the repair turn, so the broken app is sent.
+        assert chat.contents()[2].startswith("**Error:** Shiny Assistant has exceeded")
+        assert chat.sent_files == [shinyapp_tag_contents_to_filecontents(BROKEN_APP)]
+        first_repair = chat.responder.repair_task
+
+        # The next message fails before it gets to the model, like when the editor
+        # files are too large. That error message isn't from the model, so its
+        # completion must not start a repair of the previous turn's app.
+        chat.responder.start_user_turn()
+        chat.messages.append({"role": "user", "content": "Add a title"})
+        await chat.append_message({"role": "assistant", "content": "**Error:** ..."})
+        await chat.settle()
+
+        assert chat.responder.repair_task is first_repair
+        assert not chat.responder.repair_attempted
+        assert len(chat.messages) == 5
+
+    endpoint = run_with_chat([BROKEN_APP], run, rate_limit_per_minute=1)
+    assert len(endpoint.requests) == 1
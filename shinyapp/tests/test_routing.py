@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from routing import (
+    DEFAULT_MODEL,
+    QUESTION_MODEL,
+    classify_request,
+    needs_continuation,
+    route_request,
+)
+
+
+def test_classify_request():
+    assert classify_request("How do I add a plot?", has_editor_code=False) == "question"
+    assert classify_request("What is a reactive calc?", has_editor_code=True) == (
+        "question"
+    )
+    assert classify_request("Create an app that shows a histogram", False) == "app"
+    # Phrased as a question, but it's a request.
+    assert classify_request("Can you make a dashboard of sales?", False) == "app"
+    assert classify_request("Add a title", has_editor_code=True) == "edit"
+    assert classify_request("Add a title", has_editor_code=False) == "app"
+    assert classify_request("reactive.calc vs reactive.effect", False) == "question"
+    # Long messages that don't look like questions get the largest budget.
+    assert classify_request("Some context. " * 30, has_editor_code=False) == "app"
+
+
+def test_route_request():
+    question = route_request("How do I add a plot?", False, verbosity="Concise")
+    assert (question.model, question.max_tokens) == (QUESTION_MODEL, 2000)
+    question = route_request("How do I add a plot?", False, verbosity="Verbose")
+    assert question.max_tokens == 4000
+
+    edit = route_request("Fix the sidebar", True, verbosity="Concise")
+    assert (edit.kind, edit.model, edit.max_tokens) == ("edit", DEFAULT_MODEL, 8000)
+
+    app = route_request("Build an app with a map", False, verbosity="Concise")
+    assert (app.kind, app.model, app.max_tokens) == ("app", DEFAULT_MODEL, 12000)
+
+
+def test_needs_continuation():
+    truncated_app = 'Here is the app.\n\n<SHINYAPP AUTORUN="1">\n<FILE NAME="app.py">'
+    assert needs_continuation(truncated_app, "max_tokens")
+    assert not needs_continuation(truncated_app, "end_turn")
+
+    complete_app = truncated_app + "\n</FILE>\n</SHINYAPP>\n\nThe app has"
+    assert not needs_continuation(complete_app, "max_tokens")
+    assert not needs_continuation("A long explanation", "max_tokens")
+    # A second app that was cut off.
+    assert needs_continuation(complete_app + '\n<SHINYAPP AUTORUN="0">', "max_tokens")
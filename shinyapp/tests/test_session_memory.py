@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from session_memory import (
+    MAX_PRESSURE_EVICTIONS_PER_SWEEP,
+    MemoryPolicy,
+    SessionMemoryTracker,
+)
+
+MB = 1024 * 1024
+
+
+async def evict() -> None:
+    pass
+
+
+def make_tracker(n_sessions: int, watermark_mb: int) -> SessionMemoryTracker:
+    tracker = SessionMemoryTracker(MemoryPolicy(watermark_bytes=watermark_mb * MB))
+    for i in range(n_sessions):
+        record = tracker.register(f"s{i}", evict)
+        record.files_bytes = 1 * MB
+        # s0 is the most idle.
+        record.last_active = -1000.0 + i
+    return tracker
+
+
+def test_no_eviction_under_watermark():
+    tracker = make_tracker(10, watermark_mb=20)
+    assert tracker.sessions_to_evict(now=0.0) == []
+
+
+def test_pressure_eviction_goes_under_target_most_idle_first():
+    # 12 MB tracked, 11 MB watermark: evict down to 90% of it, 9.9 MB.
+    tracker = make_tracker(12, watermark_mb=11)
+    evicted = tracker.sessions_to_evict(now=0.0)
+    assert [r.session_id for r in evicted] == ["s0", "s1", "s2"]
+
+
+def test_pressure_evictions_per_sweep_are_capped():
+    tracker = make_tracker(20, watermark_mb=2)
+    evicted = tracker.sessions_to_evict(now=0.0)
+    assert len(evicted) == MAX_PRESSURE_EVICTIONS_PER_SWEEP
+
+
+def test_recently_active_sessions_are_not_evicted_for_pressure():
+    tracker = make_tracker(12, watermark_mb=11)
+    tracker.touch("s0")
+    tracker.touch("s1")
+    evicted = tracker.sessions_to_evict()
+    assert [r.session_id for r in evicted] == ["s2", "s3", "s4"]
+
+
+def test_asset_bytes_count_toward_session_memory():
+    tracker = make_tracker(1, watermark_mb=20)
+    tracker.update("s0", asset_bytes=3 * MB)
+    assert tracker.total_bytes() == 4 * MB
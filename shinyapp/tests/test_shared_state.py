@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import sqlite3
+import time
+from pathlib import Path
+
+from shared_state import BUSY_TIMEOUT_SECS, SharedState
+
+
+def test_rate_limit():
+    state = SharedState(":memory:")
+    assert state.try_acquire("requests", 2)
+    assert state.try_acquire("requests", 2)
+    assert not state.try_acquire("requests", 2)
+
+
+def test_fails_open_when_another_process_holds_the_lock(tmp_path: Path):
+    path = str(tmp_path / "state.db")
+    state = SharedState(path)
+    state.set_backoff("anthropic", 60)
+    assert state.try_acquire("requests", 1)
+    assert state.try_acquire_lease("job", "worker-1", 60)
+
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        start = time.monotonic()
+        # Over the limit, but the request is let through.
+        assert state.try_acquire("requests", 1)
+        state.record_usage("model", {"input_tokens": 1})
+        # Even the holder can't renew a lease.
+        assert not state.try_acquire_lease("job", "worker-1", 60)
+        elapsed = time.monotonic() - start
+        # Each operation gives up after the busy timeout, instead of blocking.
+        assert elapsed < 3 * BUSY_TIMEOUT_SECS + 0.5
+        # Reads don't need the lock in WAL mode.
+        assert state.backoff_remaining("anthropic") > 0
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    # The usage update was dropped.
+    assert state.usage() == []
+    assert not state.try_acquire("requests", 1)